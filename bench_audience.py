@@ -0,0 +1,102 @@
+"""Выбор получателей лички: обратный индекс в Python против колонок NumPy.
+
+Заполняет временную БД синтетическими пользователями, загружает UserManager и
+сравнивает recipient_groups по индексу подписчиков и по ColumnarUserTable.
+Нужен numpy (pip install numpy).
+
+Запуск: python bench_audience.py [--sizes 10000,100000,1000000] [--repeat 5]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+BENCH_DIR = tempfile.mkdtemp(prefix="bench_audience_")
+os.environ["DB_PATH"] = os.path.join(BENCH_DIR, "bench.db")
+os.environ["METRICS_PORT"] = "0"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(BENCH_DIR)
+
+import bot  # noqa: E402
+
+ITEMS = [("Carrot", 3), ("Corn", 2), ("Mango", 1), ("Watering Can", 2), ("Super Sprinkler", 1)]
+
+
+def seed_users(count: int, notifications_off: float, disable_prob: float, seed: int):
+    rnd = random.Random(seed)
+    bits = list(bot.ITEM_BITS.values())
+    with bot.db_pool.connection() as conn:
+        conn.execute("DELETE FROM users")
+        for start in range(0, count, 100000):
+            rows = []
+            for user_id in range(start + 1, min(count, start + 100000) + 1):
+                mask = 0
+                for bit in bits:
+                    if rnd.random() < disable_prob:
+                        mask |= bit
+                rows.append((user_id, 0 if rnd.random() < notifications_off else 1, mask))
+            conn.executemany(
+                "INSERT INTO users (user_id, username, first_seen, notifications_enabled, disabled_items) "
+                "VALUES (?, '', '', ?, ?)",
+                rows
+            )
+        conn.commit()
+
+
+def best_of(repeat: int, func):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def run_size(count: int, args):
+    seed_users(count, args.notifications_off, args.disable_prob, args.seed)
+    manager = bot.UserManager()
+    columns = manager.columns
+
+    manager.columns = None
+    loop_seconds, loop_groups = best_of(args.repeat, lambda: manager.recipient_groups(ITEMS, set()))
+    manager.columns = columns
+    columnar_seconds, columnar_groups = best_of(args.repeat, lambda: manager.recipient_groups(ITEMS, set()))
+
+    update_mask = bot.items_mask(name for name, _ in ITEMS)
+    select_seconds, _ = best_of(args.repeat, lambda: columns.select(update_mask))
+
+    same = {key: sorted(value) for key, value in loop_groups.items()} == \
+           {key: sorted(value) for key, value in columnar_groups.items()}
+    recipients = sum(len(value) for value in columnar_groups.values())
+    print(
+        f"👥 {count:>9}: получателей {recipients:>8}, групп {len(columnar_groups):>3} | "
+        f"индекс {loop_seconds * 1000:8.1f} мс | NumPy {columnar_seconds * 1000:7.1f} мс "
+        f"(только маска {select_seconds * 1000:6.1f} мс) | x{loop_seconds / columnar_seconds:.1f} | "
+        f"{'совпадает' if same else 'РАСХОЖДЕНИЕ'}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение выбора получателей лички")
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--notifications-off", type=float, default=0.1)
+    parser.add_argument("--disable-prob", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if bot.np is None or not bot.COLUMNAR_USERS:
+        print("❌ Нужен numpy и COLUMNAR_USERS=1")
+        return
+
+    for count in (int(size) for size in args.sizes.split(",")):
+        run_size(count, args)
+    bot.storage.close()
+
+
+if __name__ == "__main__":
+    main()
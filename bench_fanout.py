@@ -0,0 +1,241 @@
+"""Нагрузочный тест рассылки апдейта: send_to_destinations + MessageQueue против локального Bot API.
+
+Поднимает фейковый Bot API (задержка, 429 RetryAfter, 403 от заблокировавших бота),
+заполняет временную БД синтетическими пользователями и меряет время от апдейта
+до последней доставки, а также задержку поста в канал, поставленного сразу после
+всей рассылки. Результат - JSON, чтобы прогоны можно было сравнивать.
+
+Запуск: python bench_fanout.py --users 5000 --rate 30 --latency-ms 40 --output result.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+START_DIR = os.getcwd()
+BENCH_DIR = tempfile.mkdtemp(prefix="bench_fanout_")
+os.environ["DB_PATH"] = os.path.join(BENCH_DIR, "bench.db")
+os.environ["CHANNEL_ID"] = "-1000000000001"
+os.environ["METRICS_PORT"] = "0"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(BENCH_DIR)
+
+
+PROBE_TEXT = "bench: пост в канал после рассылки"
+
+
+class FakeBotApi:
+    """Минимальный Bot API: getMe, sendMessage, sendPhoto"""
+
+    def __init__(self, latency: float, rate_429: float, blocked: float, seed: int):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.blocked = blocked
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.delivered = 0
+        self.retry_after = 0
+        self.forbidden = 0
+        self.first_delivery = None
+        self.last_delivery = None
+        self.probe_delivered_at = None
+
+    def is_blocked(self, chat_id: int) -> bool:
+        return chat_id > 0 and (chat_id * 2654435761 % 1000) < self.blocked * 1000
+
+    def handle(self, method: str, params: dict):
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}}
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        chat_id = int(params.get("chat_id", 0))
+        with self.lock:
+            if self.random.random() < self.rate_429:
+                self.retry_after += 1
+                return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                             "parameters": {"retry_after": 1}}
+            if self.is_blocked(chat_id):
+                self.forbidden += 1
+                return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+
+            now = time.monotonic()
+            self.delivered += 1
+            self.first_delivery = self.first_delivery or now
+            self.last_delivery = now
+            message_id = self.delivered
+            if params.get("text") == PROBE_TEXT:
+                self.probe_delivered_at = now
+
+        chat_type = "private" if chat_id > 0 else "channel"
+        return 200, {"ok": True, "result": {
+            "message_id": message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": chat_type}, "text": params.get("text") or params.get("caption") or ""
+        }}
+
+
+def make_handler(api: FakeBotApi):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Заголовки и тело уходят разными send(): без этого Nagle + delayed ACK добавляют ~40 мс к ответу
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if "json" in (self.headers.get("Content-Type") or ""):
+                params = json.loads(body or b"{}")
+            else:
+                params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+            status, payload = api.handle(self.path.rsplit("/", 1)[-1], params)
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def seed_users(bot, count: int, notifications_off: float, disable_prob: float, seed: int):
+    rnd = random.Random(seed)
+    now = time.strftime("%Y-%m-%dT%H:%M:%S")
+    rows = []
+    for user_id in range(1, count + 1):
+        mask = 0
+        for bit in bot.ITEM_BITS.values():
+            if rnd.random() < disable_prob:
+                mask |= bit
+        rows.append((user_id, f"user{user_id}", now, 0 if rnd.random() < notifications_off else 1, mask))
+    with bot.db_pool.connection() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO users (user_id, username, first_seen, notifications_enabled, disabled_items) "
+            "VALUES (?, ?, ?, ?, ?)",
+            rows
+        )
+        conn.commit()
+
+
+def parse_items(spec: str):
+    items = []
+    for part in spec.split(","):
+        name, _, qty = part.partition(":")
+        items.append((name.strip(), int(qty or 1)))
+    return items
+
+
+async def run(args) -> dict:
+    api = FakeBotApi(args.latency_ms / 1000, args.rate_429, args.blocked, args.seed)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(api))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{server.server_address[1]}/bot"
+
+    import bot
+
+    started = time.perf_counter()
+    seed_users(bot, args.users, args.notifications_off, args.disable_prob, args.seed)
+    seed_seconds = time.perf_counter() - started
+
+    tg = bot.GardenHorizonsBot("123456:BENCH")
+    tg.message_queue.rate_limiter = bot.TelegramRateLimiter(global_rate=args.rate)
+    await tg.application.initialize()
+    await tg.message_queue.start()
+
+    all_items = parse_items(args.items)
+    rare_items = [(name, qty) for name, qty in all_items if bot.is_allowed_for_main_channel(name)]
+
+    # Считаем сами вызовы put(): глубина очереди после апдейта занижена, воркеры уже разбирают её
+    enqueued = 0
+    queue_put = tg.message_queue.put
+
+    async def counting_put(*put_args, **put_kwargs):
+        nonlocal enqueued
+        enqueued += 1
+        await queue_put(*put_args, **put_kwargs)
+
+    tg.message_queue.put = counting_put
+    update_started = time.monotonic()
+    await tg.discord_listener.send_to_destinations(all_items, rare_items)
+    enqueue_seconds = time.monotonic() - update_started
+    tg.message_queue.put = queue_put
+
+    # Пост в канал встаёт в очередь за всей личкой апдейта
+    probe_started = time.monotonic()
+    await tg.message_queue.put(tg.discord_listener.main_channel_id, PROBE_TEXT)
+
+    while tg.message_queue.depth():
+        await asyncio.sleep(0.05)
+    await tg.message_queue.queue.join()
+    drained_seconds = time.monotonic() - update_started
+
+    await tg.message_queue.stop()
+    await tg.application.shutdown()
+    bot.storage.close()
+    server.shutdown()
+
+    end_to_end = (api.last_delivery - update_started) if api.last_delivery else None
+    channel_latency = (api.probe_delivered_at - probe_started) if api.probe_delivered_at else None
+    send = bot.metrics.histogram("bot_send_seconds", method="sendMessage")
+    wait = bot.metrics.histogram("bot_rate_limiter_wait_seconds")
+    return {
+        "config": vars(args),
+        "users": args.users,
+        "messages_enqueued": enqueued,
+        "delivered": api.delivered,
+        "retry_after_responses": api.retry_after,
+        "forbidden_responses": api.forbidden,
+        "failed": bot.metrics.counter("bot_messages_total", result="failed"),
+        "seed_seconds": round(seed_seconds, 3),
+        "enqueue_seconds": round(enqueue_seconds, 3),
+        "drain_seconds": round(drained_seconds, 3),
+        "update_to_last_delivery_seconds": round(end_to_end, 3) if end_to_end else None,
+        "messages_per_second": round(api.delivered / end_to_end, 1) if end_to_end else 0,
+        "channel_post_latency_seconds": round(channel_latency, 3) if channel_latency else None,
+        "send_latency_p50_ms": round(send.quantile(0.5) * 1000, 1) if send else None,
+        "send_latency_p95_ms": round(send.quantile(0.95) * 1000, 1) if send else None,
+        "rate_limiter_wait_avg_ms": round(wait.sum / wait.count * 1000, 1) if wait and wait.count else 0,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест рассылки апдейта")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--items", default="Carrot:3,Mango:1,Super Sprinkler:1")
+    parser.add_argument("--notifications-off", type=float, default=0.1, help="доля пользователей с выключенными уведомлениями")
+    parser.add_argument("--disable-prob", type=float, default=0.3, help="вероятность, что предмет выключен у пользователя")
+    parser.add_argument("--rate", type=float, default=30, help="глобальный лимит сообщений в секунду")
+    parser.add_argument("--latency-ms", type=float, default=40, help="задержка ответа фейкового Bot API")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429 RetryAfter")
+    parser.add_argument("--blocked", type=float, default=0.02, help="доля пользователей, заблокировавших бота (403)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="куда дописать JSON с результатом")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(os.path.join(START_DIR, args.output), "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
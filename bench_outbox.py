@@ -0,0 +1,69 @@
+"""Сравнение пропускной способности MessageQueue: очередь в памяти против outbox в SQLite.
+
+Запуск: python bench_outbox.py [количество_сообщений] [задержка_отправки_мс]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = tempfile.mkdtemp(prefix="bench_outbox_")
+os.environ["DB_PATH"] = os.path.join(BENCH_DIR, "bench.db")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(BENCH_DIR)
+
+import bot  # noqa: E402
+
+
+class FakeBot:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.delivered = 0
+
+    async def send_message(self, chat_id, text, parse_mode=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.delivered += 1
+
+    async def send_photo(self, chat_id, photo, caption=None, parse_mode=None, **kwargs):
+        await self.send_message(chat_id, caption, parse_mode)
+
+
+class FakeApplication:
+    def __init__(self, latency: float):
+        self.bot = FakeBot(latency)
+
+
+async def run_queue(durable: bool, count: int, latency: float) -> float:
+    queue = bot.MessageQueue(durable=durable)
+    queue.application = FakeApplication(latency)
+    # Лимиты Telegram здесь не нужны: меряем накладные расходы самой очереди
+    queue.rate_limiter = bot.TelegramRateLimiter(global_rate=10 ** 9)
+    await queue.start()
+
+    started = time.perf_counter()
+    for i in range(count):
+        await queue.put(i + 1, f"Сообщение {i}")
+    while queue.application.bot.delivered < count:
+        await asyncio.sleep(0.005)
+    elapsed = time.perf_counter() - started
+
+    await queue.stop()
+    return count / elapsed
+
+
+async def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 5) / 1000
+
+    memory = await run_queue(False, count, latency)
+    durable = await run_queue(True, count, latency)
+    bot.storage.close()
+
+    print(f"📨 Сообщений: {count}, задержка отправки: {latency * 1000:.0f} мс, воркеров: {bot.MESSAGE_WORKERS}")
+    print(f"🧠 Очередь в памяти: {memory:.0f} msg/сек")
+    print(f"💾 Outbox в SQLite:  {durable:.0f} msg/сек ({durable / memory * 100:.1f}% от памяти)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
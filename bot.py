@@ -1,5 +1,9 @@
 import os
 import logging
+import logging.handlers
+import atexit
+import bisect
+import copy
 import asyncio
 import random
 import sqlite3
@@ -7,37 +11,122 @@ import time
 import json
 import re
 import html
+import hashlib
+import queue
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
-from typing import Dict, Any, Optional, List, Set, Tuple
+from typing import Dict, Any, Optional, List, Set, Tuple, Callable
 from dataclasses import dataclass, field
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from asyncio import Semaphore
 
+import httpx
 import requests
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, InputMediaPhoto, ChatMember
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, InputMediaPhoto, ChatMember, Message
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters, ConversationHandler
 from telegram.constants import ParseMode
-from telegram.error import RetryAfter, TimedOut, Forbidden, NetworkError
+from telegram.error import RetryAfter, TimedOut, Forbidden, NetworkError, BadRequest
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Загружаем переменные окружения
 load_dotenv()
 
 # ========== НАСТРОЙКА ЛОГИРОВАНИЯ ==========
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text | json
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+
+# Поля LogRecord, которые есть у любой записи; всё остальное пришло через extra=
+_STANDARD_LOG_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON; поля из extra= попадают в объект как есть"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_LOG_FIELDS:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не вклеивает traceback в msg.
+
+    Стандартный prepare() форматирует запись целиком и обнуляет exc_info, поэтому
+    JsonFormatter в потоке listener'а не видел исключения. Здесь traceback
+    превращается в текст сразу (объекты фреймов в очередь не уходят) и остаётся
+    в exc_text, а оформляет его форматтер обработчика.
+    """
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Логгеры только кладут записи в очередь; запись на диск и в консоль - в отдельном потоке"""
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+    )
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    root = logging.getLogger()
+    root.handlers = [LogQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 logging.getLogger('telegram').setLevel(logging.WARNING)
 logging.getLogger('httpx').setLevel(logging.WARNING)
 
 # ========== КОНФИГУРАЦИЯ ==========
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # например http://127.0.0.1:8082/bot для локального Bot API
 MAIN_CHANNEL_ID = os.getenv("CHANNEL_ID", "-1002808898833")
 DEFAULT_REQUIRED_CHANNEL_LINK = "https://t.me/GardenHorizonsStocks"
 
@@ -52,12 +141,27 @@ DISCORD_CHANNELS = {
 
 API_URL = os.getenv("API_URL", "https://stock.gardenhorizonswiki.com/stock.json")
 UPDATE_INTERVAL = int(os.getenv("UPDATE_INTERVAL", "10"))
+STOCK_API_TIMEOUT = float(os.getenv("STOCK_API_TIMEOUT", "5"))
+STOCK_MAX_STALENESS = float(os.getenv("STOCK_MAX_STALENESS", str(UPDATE_INTERVAL * 6)))
 ADMIN_ID = 8025951500
 
 # Оптимизации
 MAX_CONCURRENT_REQUESTS = 5
+MESSAGE_WORKERS = int(os.getenv("MESSAGE_WORKERS", "10"))
+DURABLE_OUTBOX = os.getenv("DURABLE_OUTBOX", "0") == "1"
+OUTBOX_BATCH_SIZE = 500
+OUTBOX_FLUSH_INTERVAL = 0.05
 SUBSCRIPTION_CACHE_TTL = 300
-BLACKLIST_CLEANUP_INTERVAL = 3600
+SUBSCRIPTION_NEGATIVE_TTL = int(os.getenv("SUBSCRIPTION_NEGATIVE_TTL", "30"))
+SUBSCRIPTION_PROMPT_RETRY = 60  # приглашение с ненайденной ссылкой на канал пересобираем через минуту
+STOCK_RENDER_CACHE_SIZE = 16
+COLUMNAR_USERS = os.getenv("COLUMNAR_USERS", "1") == "1"  # колонки NumPy для выбора аудитории, если numpy установлен
+
+# Хранение истории отправок: дедупликация идёт в пределах апдейта, поэтому окно в часах с запасом
+HISTORY_RETENTION_HOURS = max(1.0, float(os.getenv("HISTORY_RETENTION_HOURS", "72")))
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", "3600"))
+RETENTION_BATCH_SIZE = 2000
+RETENTION_VACUUM_PAGES = 2000
 
 # Часовой пояс Москвы (UTC+3)
 MSK_TIMEZONE = timezone(timedelta(hours=3))
@@ -74,8 +178,8 @@ if os.environ.get('RAILWAY_ENVIRONMENT'):
         DB_PATH = "/tmp/bot.db"
         logger.info(f"✅ Использую временную БД: {DB_PATH}")
 else:
-    DB_PATH = "bot.db"
-    logger.info("✅ Локальная разработка, БД в bot.db")
+    DB_PATH = os.getenv("DB_PATH", "bot.db")
+    logger.info(f"✅ Локальная разработка, БД в {DB_PATH}")
 
 # URL изображений
 IMAGE_MAIN = "https://i.postimg.cc/J4JdrN5z/image.png"
@@ -123,6 +227,31 @@ GEAR_LIST = ["Watering Can", "Basic Sprinkler", "Harvest Bell", "Turbo Sprinkler
 WEATHER_LIST = ["fog", "rain", "snow", "storm", "sandstorm", "starfall"]
 RARE_ITEMS = ["Super Sprinkler", "Favorite Tool", "starfall", "Mango", "Bamboo"]
 
+# Номер бита предмета в маске настроек = позиция в своём списке + смещение категории.
+# Новые предметы добавлять только в конец списков, иначе сохранённые маски сдвинутся.
+ITEM_BIT_OFFSETS = ((SEEDS_LIST, 0), (GEAR_LIST, 32), (WEATHER_LIST, 48))
+ITEM_BITS = {
+    item: 1 << (offset + position)
+    for items, offset in ITEM_BIT_OFFSETS
+    for position, item in enumerate(items)
+}
+ALL_ITEMS_MASK = sum(ITEM_BITS.values())
+
+def items_mask(item_names) -> int:
+    mask = 0
+    for item_name in item_names:
+        mask |= ITEM_BITS.get(item_name, 0)
+    return mask
+
+# Статусы пользователя (users.status): всё, кроме active, - чат недоступен навсегда
+USER_ACTIVE = 'active'
+USER_STATUS_NAMES = {
+    'active': 'активные',
+    'blocked': 'заблокировали бота',
+    'deactivated': 'удалили аккаунт',
+    'not_found': 'чат не найден'
+}
+
 def translate(text: str) -> str:
     return TRANSLATIONS.get(text, text)
 
@@ -163,139 +292,473 @@ def is_night_time_msk() -> bool:
     # Ночь с 1:00 до 8:00
     return 1 <= hour < 8
 
+# ========== МЕТРИКИ ==========
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # эндпоинт /metrics включается явно, например METRICS_PORT=9100
+LOOP_LAG_INTERVAL = 1.0
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUEUE_WAIT_BUCKETS = LATENCY_BUCKETS + (30.0, 60.0, 300.0, 900.0)  # личка и рассылки ждут минутами
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    def quantile(self, q: float) -> float:
+        """Приблизительный квантиль: верхняя граница корзины, в которую он попал"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class Metrics:
+    """Счётчики и гистограммы в памяти; текст для Prometheus собирается только при запросе"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, tuple], float] = {}
+        self._histograms: Dict[Tuple[str, tuple], Histogram] = {}
+        self._gauges: Dict[Tuple[str, tuple], Tuple[str, Callable[[], float]]] = {}
+        self._help: Dict[str, str] = {}
+        self._rate_samples = deque(maxlen=61)
+        self.loop_lag = 0.0
+        self.loop_lag_max = 0.0
+    
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+    
+    def gauge(self, name: str, func: Callable[[], float], help_text: str = "", kind: str = "gauge", **labels):
+        """Значение считается функцией в момент запроса - между запросами ничего не стоит"""
+        self._gauges[(name, tuple(sorted(labels.items())))] = (kind, func)
+        if help_text:
+            self.describe(name, help_text)
+    
+    def counter(self, name: str, **labels) -> float:
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+    
+    def histogram(self, name: str, **labels) -> Optional[Histogram]:
+        return self._histograms.get((name, tuple(sorted(labels.items()))))
+    
+    def histograms(self, name: str) -> Dict[tuple, Histogram]:
+        return {labels: h for (metric, labels), h in self._histograms.items() if metric == name}
+    
+    def sample_rates(self):
+        self._rate_samples.append((
+            time.monotonic(),
+            self.counter('bot_messages_total', result='sent'),
+            self.counter('bot_messages_total', result='failed')
+        ))
+    
+    def message_rates(self) -> Tuple[float, float]:
+        """Отправлено/ошибок в секунду за последнюю минуту"""
+        if len(self._rate_samples) < 2:
+            return 0.0, 0.0
+        (t0, sent0, failed0), (t1, sent1, failed1) = self._rate_samples[0], self._rate_samples[-1]
+        elapsed = t1 - t0
+        if elapsed <= 0:
+            return 0.0, 0.0
+        return (sent1 - sent0) / elapsed, (failed1 - failed0) / elapsed
+    
+    @staticmethod
+    def _escape(value) -> str:
+        # Экранирование значений меток по текстовому формату Prometheus
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = [f'{key}="{Metrics._escape(value)}"' for key, value in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+    
+    def _header(self, lines: List[str], name: str, kind: str, seen: Set[str]):
+        if name in seen:
+            return
+        seen.add(name)
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+    
+    def render(self) -> str:
+        lines: List[str] = []
+        seen: Set[str] = set()
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            histograms = [(key, h.buckets, list(h.counts), h.sum, h.count) for key, h in histograms]
+        
+        for (name, labels), (kind, func) in sorted(self._gauges.items(), key=lambda item: item[0]):
+            try:
+                value = func()
+            except Exception:
+                continue
+            self._header(lines, name, kind, seen)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        
+        for (name, labels), value in counters:
+            self._header(lines, name, "counter", seen)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        
+        for (name, labels), buckets, counts, total, count in histograms:
+            self._header(lines, name, "histogram", seen)
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = self._labels(labels, f'le="{bound}"')
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            inf_labels = self._labels(labels, 'le="+Inf"')
+            lines.append(f"{name}_bucket{inf_labels} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        
+        return "\n".join(lines) + "\n"
+    
+    async def monitor_loop(self):
+        """Задержка event loop: насколько позже запланированного просыпается sleep"""
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(0.0, time.monotonic() - started - LOOP_LAG_INTERVAL)
+            self.loop_lag = lag
+            self.loop_lag_max = max(self.loop_lag_max, lag)
+            self.observe('bot_event_loop_lag_seconds', lag)
+            self.sample_rates()
+    
+    async def _handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while True:
+                header = await asyncio.wait_for(reader.readline(), 5)
+                if header in (b"\r\n", b"\n", b""):
+                    break
+            
+            path = request_line.split()[1].decode() if len(request_line.split()) > 1 else "/"
+            if path.split("?")[0] in ("/", "/metrics"):
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.debug("Ошибка запроса метрик: %s", e)
+        finally:
+            writer.close()
+    
+    async def serve(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        if not port:
+            return None
+        try:
+            server = await asyncio.start_server(self._handle_http, host, port)
+            logger.info(f"📈 Метрики: http://{host}:{port}/metrics")
+            return server
+        except OSError as e:
+            logger.error(f"❌ Не удалось поднять эндпоинт метрик на {host}:{port}: {e}")
+            return None
+
+metrics = Metrics()
+metrics.describe('bot_messages_total', 'Сообщения, обработанные очередью, по результату')
+metrics.describe('bot_send_errors_total', 'Неудачные попытки отправки по причине (dead, invalid, transient, retry_after, failed)')
+metrics.describe('bot_message_retries_total', 'Отложенные повторы отправки по причине')
+metrics.describe('bot_queue_wait_seconds', 'Ожидание сообщения в полосе очереди до воркера')
+metrics.describe('bot_send_seconds', 'Длительность вызова Telegram API по методу')
+metrics.describe('bot_rate_limiter_wait_seconds', 'Ожидание слота в ограничителе запросов')
+metrics.describe('bot_db_seconds', 'Длительность операций с БД (read - в пуле потоков, commit - групповой коммит)')
+metrics.describe('bot_event_loop_lag_seconds', 'Задержка event loop')
+
 # ========== БАЗА ДАННЫХ ==========
 
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_STATEMENT_CACHE_SIZE = 256
+
 def get_db():
-    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=30,
+        check_same_thread=False,
+        cached_statements=DB_STATEMENT_CACHE_SIZE
+    )
     conn.execute("PRAGMA journal_mode=WAL")
     conn.execute("PRAGMA cache_size=-20000")
     conn.execute("PRAGMA synchronous=NORMAL")
     conn.execute("PRAGMA temp_store=MEMORY")
     return conn
 
+class ConnectionPool:
+    """Пул долгоживущих соединений SQLite.
+
+    PRAGMA выполняются один раз при открытии соединения, а подготовленные
+    выражения остаются в кэше соединения (cached_statements) между запросами.
+    """
+
+    def __init__(self, size: int = DB_POOL_SIZE):
+        self.size = max(1, size)
+        self.connections_opened = 0
+        self._created = 0
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def open_connection(self) -> sqlite3.Connection:
+        conn = get_db()
+        with self._lock:
+            self.connections_opened += 1
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_open = self._created < self.size
+            if can_open:
+                self._created += 1
+
+        if can_open:
+            try:
+                return self.open_connection()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=30)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Пул соединений исчерпан")
+
+    def release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+db_pool = ConnectionPool()
+
 def clear_stocks_on_deploy():
-    """Очищает таблицы с историей стоков при каждом деплое на Railway"""
+    """Чистит завершённые рассылки при деплое на Railway.
+
+    История стоков больше не стирается целиком: её подрезает RetentionJob,
+    так что дедупликация переживает деплой.
+    """
     try:
         if os.environ.get('RAILWAY_ENVIRONMENT'):
-            logger.info("🧹 Railway деплой: очищаю историю стоков...")
-            conn = get_db()
-            cur = conn.cursor()
+            logger.info("🧹 Railway деплой: очищаю завершённые рассылки...")
+            with db_pool.connection() as conn:
+                cur = conn.cursor()
             
-            # Проверяем какие таблицы существуют
-            cur.execute("SELECT name FROM sqlite_master WHERE type='table';")
-            tables = [t[0] for t in cur.fetchall()]
-            logger.info(f"📋 Найдены таблицы: {tables}")
-            
-            # Очищаем только таблицы с историей стоков
-            stock_tables = ['sent_items', 'user_sent_items', 'weather_notifications', 'mailing_history']
-            for table in stock_tables:
-                if table in tables:
-                    cur.execute(f"DELETE FROM {table};")
-                    logger.info(f"✅ {table}: очищено {cur.rowcount} записей")
+                # Незавершённые рассылки оставляем, чтобы продолжить их после деплоя
+                cur.execute("""
+                    DELETE FROM mailing_deliveries WHERE campaign_id NOT IN (
+                        SELECT id FROM mailing_history WHERE status IN ('running', 'paused')
+                    )
+                """)
+                cur.execute("DELETE FROM mailing_history WHERE COALESCE(status, 'done') NOT IN ('running', 'paused')")
+                logger.info(f"✅ mailing_history: очищено {cur.rowcount} записей")
             
-            conn.commit()
-            conn.close()
-            logger.info("✅ История стоков успешно очищена при деплое")
+                conn.commit()
+            logger.info(f"✅ История стоков хранится {HISTORY_RETENTION_HOURS:.0f} ч и чистится в фоне")
     except Exception as e:
-        logger.error(f"❌ Ошибка при очистке стоков: {e}")
+        logger.error(f"❌ Ошибка при очистке рассылок: {e}")
 
 def init_database():
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        logger.info(f"✅ Подключение к БД успешно: {DB_PATH}")
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_seen TEXT,
-                notifications_enabled INTEGER DEFAULT 1
-            )
-        """)
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS mandatory_channels (
-                channel_id TEXT PRIMARY KEY,
-                channel_name TEXT
-            )
-        """)
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS posting_channels (
-                channel_id TEXT PRIMARY KEY,
-                name TEXT,
-                username TEXT,
-                added_at TEXT
-            )
-        """)
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS sent_items (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER,
-                item_name TEXT,
-                quantity INTEGER,
-                update_id TEXT,
-                sent_at TEXT,
-                UNIQUE(chat_id, item_name, quantity, update_id)
-            )
-        """)
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS user_items (
-                user_id INTEGER,
-                item_name TEXT,
-                enabled INTEGER DEFAULT 1,
-                PRIMARY KEY (user_id, item_name)
-            )
-        """)
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS user_sent_items (
-                user_id INTEGER,
-                item_name TEXT,
-                quantity INTEGER,
-                sent_at TEXT,
-                update_id TEXT,
-                PRIMARY KEY (user_id, item_name, update_id)
-            )
-        """)
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS weather_notifications (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                weather_type TEXT,
-                status TEXT,
-                update_id TEXT,
-                sent_at TEXT,
-                UNIQUE(weather_type, status, update_id)
-            )
-        """)
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS mailing_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                admin_id INTEGER,
-                text TEXT,
-                sent_at TEXT,
-                success_count INTEGER,
-                failed_count INTEGER,
-                total_count INTEGER
-            )
-        """)
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            logger.info(f"✅ Подключение к БД успешно: {DB_PATH}")
+        
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    first_seen TEXT,
+                    notifications_enabled INTEGER DEFAULT 1,
+                    disabled_items INTEGER DEFAULT 0,
+                    status TEXT DEFAULT 'active',
+                    status_changed_at TEXT
+                )
+            """)
         
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_sent_items_update ON sent_items(update_id)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_user_sent_items_update ON user_sent_items(update_id, user_id)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_user_items_lookup ON user_items(user_id, item_name)")
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS mandatory_channels (
+                    channel_id TEXT PRIMARY KEY,
+                    channel_name TEXT
+                )
+            """)
+        
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS posting_channels (
+                    channel_id TEXT PRIMARY KEY,
+                    name TEXT,
+                    username TEXT,
+                    added_at TEXT
+                )
+            """)
+        
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS sent_items (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER,
+                    item_name TEXT,
+                    quantity INTEGER,
+                    update_id TEXT,
+                    sent_at TEXT,
+                    UNIQUE(chat_id, item_name, quantity, update_id)
+                )
+            """)
+        
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS user_items (
+                    user_id INTEGER,
+                    item_name TEXT,
+                    enabled INTEGER DEFAULT 1,
+                    PRIMARY KEY (user_id, item_name)
+                )
+            """)
+        
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS user_sent_items (
+                    user_id INTEGER,
+                    item_name TEXT,
+                    quantity INTEGER,
+                    sent_at TEXT,
+                    update_id TEXT,
+                    PRIMARY KEY (user_id, item_name, update_id)
+                )
+            """)
+        
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS weather_notifications (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    weather_type TEXT,
+                    status TEXT,
+                    update_id TEXT,
+                    sent_at TEXT,
+                    UNIQUE(weather_type, status, update_id)
+                )
+            """)
+        
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS mailing_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    admin_id INTEGER,
+                    text TEXT,
+                    sent_at TEXT,
+                    success_count INTEGER,
+                    failed_count INTEGER,
+                    total_count INTEGER,
+                    status TEXT DEFAULT 'done',
+                    progress_chat_id INTEGER,
+                    progress_message_id INTEGER,
+                    updated_at TEXT
+                )
+            """)
+        
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS mailing_deliveries (
+                    campaign_id INTEGER,
+                    user_id INTEGER,
+                    status TEXT DEFAULT 'pending',
+                    updated_at TEXT,
+                    PRIMARY KEY (campaign_id, user_id)
+                )
+            """)
+        
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY,
+                    chat_id INTEGER,
+                    text TEXT,
+                    parse_mode TEXT,
+                    photo TEXT,
+                    created_at TEXT
+                )
+            """)
+        
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS dead_letters (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER,
+                    text TEXT,
+                    parse_mode TEXT,
+                    photo TEXT,
+                    cause TEXT,
+                    error TEXT,
+                    attempts INTEGER,
+                    created_at TEXT,
+                    lane TEXT
+                )
+            """)
         
-        conn.commit()
-        conn.close()
-        logger.info("✅ База данных инициализирована успешно")
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS media_cache (
+                    url TEXT PRIMARY KEY,
+                    file_id TEXT,
+                    updated_at TEXT
+                )
+            """)
         
-        # Очищаем стоки при деплое (после создания таблиц)
-        clear_stocks_on_deploy()
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_sent_items_update ON sent_items(update_id)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_user_sent_items_update ON user_sent_items(update_id, user_id)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_user_items_lookup ON user_items(user_id, item_name)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_sent_items_sent_at ON sent_items(sent_at)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_user_sent_items_sent_at ON user_sent_items(sent_at)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_weather_notifications_sent_at ON weather_notifications(sent_at)")
         
+            conn.commit()
+        logger.info("✅ База данных инициализирована успешно")
         return True
         
     except Exception as e:
@@ -306,166 +769,226 @@ init_database()
 
 # ========== МИГРАЦИЯ БАЗЫ ДАННЫХ ==========
 try:
-    conn = get_db()
-    cur = conn.cursor()
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
     
-    cur.execute("PRAGMA table_info(sent_items)")
-    columns = [column[1] for column in cur.fetchall()]
-    
-    if 'update_id' not in columns:
-        logger.warning("⚠️ Таблица sent_items не содержит колонку update_id. Запускаю миграцию...")
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS sent_items_new (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER,
-                item_name TEXT,
-                quantity INTEGER,
-                update_id TEXT,
-                sent_at TEXT,
-                UNIQUE(chat_id, item_name, quantity, update_id)
-            )
-        """)
+        cur.execute("PRAGMA table_info(sent_items)")
+        columns = [column[1] for column in cur.fetchall()]
+    
+        if 'update_id' not in columns:
+            logger.warning("⚠️ Таблица sent_items не содержит колонку update_id. Запускаю миграцию...")
+        
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS sent_items_new (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER,
+                    item_name TEXT,
+                    quantity INTEGER,
+                    update_id TEXT,
+                    sent_at TEXT,
+                    UNIQUE(chat_id, item_name, quantity, update_id)
+                )
+            """)
         
-        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='sent_items'")
-        if cur.fetchone():
-            try:
-                cur.execute("PRAGMA table_info(sent_items)")
-                old_columns = [col[1] for col in cur.fetchall()]
+            cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='sent_items'")
+            if cur.fetchone():
+                try:
+                    cur.execute("PRAGMA table_info(sent_items)")
+                    old_columns = [col[1] for col in cur.fetchall()]
                 
-                if 'update_id' in old_columns:
-                    logger.info("✅ Колонка update_id уже существует в sent_items")
-                else:
-                    cur.execute("""
-                        INSERT INTO sent_items_new (id, chat_id, item_name, quantity, sent_at)
-                        SELECT id, chat_id, item_name, quantity, sent_at FROM sent_items
-                    """)
+                    if 'update_id' in old_columns:
+                        logger.info("✅ Колонка update_id уже существует в sent_items")
+                    else:
+                        cur.execute("""
+                            INSERT INTO sent_items_new (id, chat_id, item_name, quantity, sent_at)
+                            SELECT id, chat_id, item_name, quantity, sent_at FROM sent_items
+                        """)
                     
-                    cur.execute("DROP TABLE sent_items")
-                    cur.execute("ALTER TABLE sent_items_new RENAME TO sent_items")
-            except Exception as e:
-                logger.error(f"❌ Ошибка при копировании данных: {e}")
-        else:
-            cur.execute("ALTER TABLE sent_items_new RENAME TO sent_items")
+                        cur.execute("DROP TABLE sent_items")
+                        cur.execute("ALTER TABLE sent_items_new RENAME TO sent_items")
+                except Exception as e:
+                    logger.error(f"❌ Ошибка при копировании данных: {e}")
+            else:
+                cur.execute("ALTER TABLE sent_items_new RENAME TO sent_items")
         
-        conn.commit()
-        logger.info("✅ Миграция таблицы sent_items завершена")
+            conn.commit()
+            logger.info("✅ Миграция таблицы sent_items завершена")
     
-    conn.close()
 except Exception as e:
     logger.error(f"❌ Критическая ошибка при миграции БД: {e}", exc_info=True)
 
-# ========== ФУНКЦИИ ДЛЯ РАБОТЫ С БД ==========
-
-def add_user_to_db(user_id: int, username: str = ""):
-    try:
-        conn = get_db()
+# Настройки предметов: строки user_items -> одна маска отключённых предметов в users
+try:
+    with db_pool.connection() as conn:
         cur = conn.cursor()
         
-        cur.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-        if cur.fetchone():
-            cur.execute(
-                "UPDATE users SET username = ? WHERE user_id = ?",
-                (username, user_id)
-            )
-        else:
-            cur.execute(
-                "INSERT INTO users (user_id, username, first_seen) VALUES (?, ?, ?)",
-                (user_id, username, datetime.now().isoformat())
-            )
-            for item in SEEDS_LIST + GEAR_LIST + WEATHER_LIST:
-                cur.execute(
-                    "INSERT INTO user_items (user_id, item_name, enabled) VALUES (?, ?, 1)",
-                    (user_id, item)
-                )
+        cur.execute("PRAGMA table_info(users)")
+        columns = [column[1] for column in cur.fetchall()]
         
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logger.error(f"❌ Ошибка добавления пользователя {user_id}: {e}")
+        if 'disabled_items' not in columns:
+            logger.warning("⚠️ Таблица users не содержит колонку disabled_items. Запускаю миграцию...")
+            cur.execute("ALTER TABLE users ADD COLUMN disabled_items INTEGER DEFAULT 0")
+            
+            disabled: Dict[int, int] = {}
+            cur.execute("SELECT user_id, item_name FROM user_items WHERE enabled = 0")
+            for user_id, item_name in cur.fetchall():
+                disabled[user_id] = disabled.get(user_id, 0) | ITEM_BITS.get(item_name, 0)
+            
+            cur.executemany(
+                "UPDATE users SET disabled_items = ? WHERE user_id = ?",
+                [(mask, user_id) for user_id, mask in disabled.items()]
+            )
+            conn.commit()
+            logger.info(f"✅ Миграция настроек предметов завершена: {len(disabled)} пользователей с отключёнными предметами")
+    
+except Exception as e:
+    logger.error(f"❌ Критическая ошибка при миграции настроек предметов: {e}", exc_info=True)
 
-def get_user_settings(user_id: int) -> Dict:
-    try:
-        conn = get_db()
+# Рассылки: колонки состояния кампании в mailing_history
+try:
+    with db_pool.connection() as conn:
         cur = conn.cursor()
         
-        cur.execute("""
-            SELECT u.notifications_enabled, ui.item_name, ui.enabled 
-            FROM users u
-            LEFT JOIN user_items ui ON u.user_id = ui.user_id
-            WHERE u.user_id = ?
-        """, (user_id,))
+        cur.execute("PRAGMA table_info(mailing_history)")
+        columns = [column[1] for column in cur.fetchall()]
         
-        rows = cur.fetchall()
-        conn.close()
-        
-        if not rows:
-            return {
-                'notifications_enabled': True,
-                'seeds': {item: True for item in SEEDS_LIST},
-                'gear': {item: True for item in GEAR_LIST},
-                'weather': {item: True for item in WEATHER_LIST}
-            }
+        new_columns = {
+            'status': "TEXT DEFAULT 'done'",
+            'progress_chat_id': "INTEGER",
+            'progress_message_id': "INTEGER",
+            'updated_at': "TEXT"
+        }
+        for column, definition in new_columns.items():
+            if column not in columns:
+                cur.execute(f"ALTER TABLE mailing_history ADD COLUMN {column} {definition}")
+                logger.info(f"✅ mailing_history: добавлена колонка {column}")
+        conn.commit()
+    
+except Exception as e:
+    logger.error(f"❌ Критическая ошибка при миграции mailing_history: {e}", exc_info=True)
+
+# Статус пользователя: недоступные чаты не попадают в рассылки
+try:
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
         
-        notifications_enabled = bool(rows[0][0])
-        items = {row[1]: bool(row[2]) for row in rows if row[1]}
+        cur.execute("PRAGMA table_info(users)")
+        columns = [column[1] for column in cur.fetchall()]
         
-        return {
-            'notifications_enabled': notifications_enabled,
-            'seeds': {item: items.get(item, True) for item in SEEDS_LIST},
-            'gear': {item: items.get(item, True) for item in GEAR_LIST},
-            'weather': {item: items.get(item, True) for item in WEATHER_LIST}
-        }
-    except Exception as e:
-        logger.error(f"❌ Ошибка получения настроек пользователя {user_id}: {e}")
-        return {
-            'notifications_enabled': True,
-            'seeds': {item: True for item in SEEDS_LIST},
-            'gear': {item: True for item in GEAR_LIST},
-            'weather': {item: True for item in WEATHER_LIST}
-        }
+        if 'status' not in columns:
+            cur.execute("ALTER TABLE users ADD COLUMN status TEXT DEFAULT 'active'")
+            logger.info("✅ users: добавлена колонка status")
+        if 'status_changed_at' not in columns:
+            cur.execute("ALTER TABLE users ADD COLUMN status_changed_at TEXT")
+            logger.info("✅ users: добавлена колонка status_changed_at")
+        conn.commit()
+    
+except Exception as e:
+    logger.error(f"❌ Критическая ошибка при миграции статуса пользователей: {e}", exc_info=True)
 
-def update_user_setting(user_id: int, setting: str, value: Any):
-    try:
-        conn = get_db()
+# Недоставленные сообщения: полоса очереди, в которую их вернуть при повторе
+try:
+    with db_pool.connection() as conn:
         cur = conn.cursor()
         
-        if setting == 'notifications_enabled':
-            cur.execute(
-                "UPDATE users SET notifications_enabled = ? WHERE user_id = ?",
-                (1 if value else 0, user_id)
-            )
-        elif setting.startswith('seed_') or setting.startswith('gear_') or setting.startswith('weather_'):
-            item_name = setting.replace('seed_', '').replace('gear_', '').replace('weather_', '')
-            cur.execute(
-                "UPDATE user_items SET enabled = ? WHERE user_id = ? AND item_name = ?",
-                (1 if value else 0, user_id, item_name)
-            )
+        cur.execute("PRAGMA table_info(dead_letters)")
+        columns = [column[1] for column in cur.fetchall()]
         
+        if 'lane' not in columns:
+            cur.execute("ALTER TABLE dead_letters ADD COLUMN lane TEXT")
+            logger.info("✅ dead_letters: добавлена колонка lane")
         conn.commit()
-        conn.close()
-    except Exception as e:
-        logger.error(f"❌ Ошибка обновления настройки {setting} для {user_id}: {e}")
+    
+except Exception as e:
+    logger.error(f"❌ Критическая ошибка при миграции dead_letters: {e}", exc_info=True)
 
-def get_all_users() -> List[int]:
+# Очищаем рассылки при деплое - после миграций, когда в mailing_history уже есть колонка status
+clear_stocks_on_deploy()
+
+def enable_incremental_vacuum():
+    """Переводит БД на auto_vacuum=INCREMENTAL.
+
+    Режим меняется только полным VACUUM, который переписывает весь файл, поэтому
+    вызывается из main() перед запуском бота, а не при импорте модуля.
+    """
     try:
-        conn = get_db()
+        with db_pool.connection() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                logger.info("🔄 Перевод БД на auto_vacuum=INCREMENTAL (разовый VACUUM)...")
+                conn.commit()
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("VACUUM")
+                logger.info("✅ auto_vacuum=INCREMENTAL включён")
+    
+    except Exception as e:
+        logger.error(f"❌ Ошибка при включении auto_vacuum: {e}", exc_info=True)
+
+# ========== ФУНКЦИИ ДЛЯ РАБОТЫ С БД ==========
+
+SQL_UPSERT_USER = (
+    "INSERT INTO users (user_id, username, first_seen, disabled_items) VALUES (?, ?, ?, 0) "
+    "ON CONFLICT(user_id) DO UPDATE SET username = excluded.username"
+)
+
+def iter_user_settings_rows(batch_size: int = 5000):
+    """Построчно отдаёт (user_id, username, notifications_enabled, items_mask, status) для всех пользователей"""
+    with db_pool.connection() as conn:
         cur = conn.cursor()
-        cur.execute("SELECT user_id FROM users")
-        users = [row[0] for row in cur.fetchall()]
-        conn.close()
-        return users
+        cur.execute(
+            "SELECT user_id, username, notifications_enabled, disabled_items, status FROM users ORDER BY user_id"
+        )
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            for user_id, username, notifications_enabled, disabled_items, status in rows:
+                yield (user_id, username or "", bool(notifications_enabled),
+                       ALL_ITEMS_MASK & ~(disabled_items or 0), status or USER_ACTIVE)
+
+def user_setting_statement(user_id: int, setting: str, value: Any) -> Optional[Tuple[str, tuple]]:
+    """SQL и параметры для изменения одной настройки пользователя"""
+    if setting == 'notifications_enabled':
+        return (
+            "UPDATE users SET notifications_enabled = ? WHERE user_id = ?",
+            (1 if value else 0, user_id)
+        )
+    if setting.startswith('seed_') or setting.startswith('gear_') or setting.startswith('weather_'):
+        item_name = setting.replace('seed_', '').replace('gear_', '').replace('weather_', '')
+        bit = ITEM_BITS.get(item_name)
+        if bit is None:
+            return None
+        if value:
+            return "UPDATE users SET disabled_items = disabled_items & ~? WHERE user_id = ?", (bit, user_id)
+        return "UPDATE users SET disabled_items = disabled_items | ? WHERE user_id = ?", (bit, user_id)
+    return None
+
+def get_active_users() -> List[int]:
+    try:
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT user_id FROM users WHERE COALESCE(status, 'active') = 'active'")
+            return [row[0] for row in cur.fetchall()]
     except Exception as e:
-        logger.error(f"❌ Ошибка получения списка пользователей: {e}")
+        logger.error(f"❌ Ошибка получения списка активных пользователей: {e}")
         return []
 
+def get_user_status_counts() -> Dict[str, int]:
+    """Количество пользователей по статусу: active, blocked, deactivated, not_found"""
+    try:
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT COALESCE(status, 'active'), COUNT(*) FROM users GROUP BY 1")
+            return dict(cur.fetchall())
+    except Exception as e:
+        logger.error(f"❌ Ошибка подсчёта статусов пользователей: {e}")
+        return {}
+
 def get_users_count() -> int:
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM users")
-        count = cur.fetchone()[0]
-        conn.close()
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM users")
+            count = cur.fetchone()[0]
         return count
     except Exception as e:
         logger.error(f"❌ Ошибка получения количества пользователей: {e}")
@@ -473,248 +996,735 @@ def get_users_count() -> int:
 
 def get_mandatory_channels() -> List[Dict]:
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("SELECT channel_id, channel_name FROM mandatory_channels ORDER BY channel_id")
-        channels = [{'id': row[0], 'name': row[1]} for row in cur.fetchall()]
-        conn.close()
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT channel_id, channel_name FROM mandatory_channels ORDER BY channel_id")
+            channels = [{'id': row[0], 'name': row[1]} for row in cur.fetchall()]
         return channels
     except Exception as e:
         logger.error(f"❌ Ошибка получения каналов ОП: {e}")
         return []
 
-def add_mandatory_channel(channel_id: str, channel_name: str):
-    try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT OR REPLACE INTO mandatory_channels (channel_id, channel_name) VALUES (?, ?)",
-            (str(channel_id), channel_name)
-        )
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logger.error(f"❌ Ошибка добавления канала ОП в БД: {e}")
-
-def remove_mandatory_channel(channel_id: str):
-    try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM mandatory_channels WHERE channel_id = ?", (str(channel_id),))
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logger.error(f"❌ Ошибка удаления канала ОП из БД: {e}")
-
 def get_posting_channels() -> List[Dict]:
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("SELECT channel_id, name, username FROM posting_channels ORDER BY added_at")
-        channels = [
-            {'id': row[0], 'name': row[1], 'username': row[2]}
-            for row in cur.fetchall()
-        ]
-        conn.close()
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT channel_id, name, username FROM posting_channels ORDER BY added_at")
+            channels = [
+                {'id': row[0], 'name': row[1], 'username': row[2]}
+                for row in cur.fetchall()
+            ]
         return channels
     except Exception as e:
         logger.error(f"❌ Ошибка получения каналов автопостинга: {e}")
         return []
 
-def add_posting_channel(channel_id: str, name: str, username: str = None):
+SQL_ADD_MANDATORY_CHANNEL = "INSERT OR REPLACE INTO mandatory_channels (channel_id, channel_name) VALUES (?, ?)"
+SQL_REMOVE_MANDATORY_CHANNEL = "DELETE FROM mandatory_channels WHERE channel_id = ?"
+SQL_ADD_POSTING_CHANNEL = (
+    "INSERT OR REPLACE INTO posting_channels (channel_id, name, username, added_at) VALUES (?, ?, ?, ?)"
+)
+SQL_REMOVE_POSTING_CHANNEL = "DELETE FROM posting_channels WHERE channel_id = ?"
+
+class ChannelRegistry:
+    """Каналы ОП и автопостинга в памяти: читаются из БД при старте и после каждого изменения.
+
+    Чтение идёт через storage.read (refresh), изменения - через поток-писатель (write),
+    свойства только отдают готовый снимок и в event loop базу не трогают.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = 0
+        self.loads = 0
+        self.loaded_version = -1
+        self._mandatory: Tuple[Dict, ...] = ()
+        self._posting: Tuple[Dict, ...] = ()
+    
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+    
+    @staticmethod
+    def _load() -> Tuple[Tuple[Dict, ...], Tuple[Dict, ...]]:
+        return tuple(get_mandatory_channels()), tuple(get_posting_channels())
+    
+    async def write(self, sql: str, params: tuple):
+        """Меняет каналы в БД и перечитывает снимок; ошибка записи пробрасывается вызывающему"""
+        try:
+            await storage.write(sql, params)
+        finally:
+            self.invalidate()
+            await self.refresh()
+    
+    async def refresh(self):
+        """Перечитывает каналы, если с прошлой загрузки реестр менялся"""
+        version = self.version
+        if self.loaded_version == version:
+            return
+        # Снимки неизменяемые: читатели держат ссылку на старый кортеж, пока мы грузим новый
+        self._mandatory, self._posting = await storage.read(self._load)
+        self.loaded_version = version
+        self.loads += 1
+    
+    @property
+    def mandatory(self) -> Tuple[Dict, ...]:
+        return self._mandatory
+    
+    @property
+    def posting(self) -> Tuple[Dict, ...]:
+        return self._posting
+
+channel_registry = ChannelRegistry()
+
+SQL_SET_USER_STATUS = "UPDATE users SET status = ?, status_changed_at = ? WHERE user_id = ?"
+SQL_MARK_ITEM_SENT_TO_USER = (
+    "INSERT OR IGNORE INTO user_sent_items (user_id, item_name, quantity, sent_at, update_id) VALUES (?, ?, ?, ?, ?)"
+)
+SQL_MARK_ITEM_SENT = (
+    "INSERT OR IGNORE INTO sent_items (chat_id, item_name, quantity, update_id, sent_at) VALUES (?, ?, ?, ?, ?)"
+)
+SQL_MARK_WEATHER_SENT = (
+    "INSERT OR IGNORE INTO weather_notifications (weather_type, status, update_id, sent_at) VALUES (?, ?, ?, ?)"
+)
+
+def get_sent_items_for_update(update_id: str) -> Set[Tuple[int, str, int]]:
+    """Все (user_id, item_name, quantity), уже отправленные в рамках апдейта, одним запросом"""
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT OR REPLACE INTO posting_channels (channel_id, name, username, added_at) VALUES (?, ?, ?, ?)",
-            (str(channel_id), name, username, datetime.now().isoformat())
-        )
-        conn.commit()
-        conn.close()
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT user_id, item_name, quantity FROM user_sent_items WHERE update_id = ?",
+                (update_id,)
+            )
+            return set(cur.fetchall())
     except Exception as e:
-        logger.error(f"❌ Ошибка добавления канала автопостинга в БД: {e}")
+        logger.error(f"❌ Ошибка загрузки отправленных предметов апдейта {update_id}: {e}")
+        return set()
 
-def remove_posting_channel(channel_id: str):
+def was_weather_notification_sent(weather_type: str, status: str, update_id: str) -> bool:
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM posting_channels WHERE channel_id = ?", (str(channel_id),))
-        conn.commit()
-        conn.close()
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT COUNT(*) FROM weather_notifications WHERE weather_type = ? AND status = ? AND update_id = ?",
+                (weather_type, status, update_id)
+            )
+            count = cur.fetchone()[0]
+        return count > 0
     except Exception as e:
-        logger.error(f"❌ Ошибка удаления канала автопостинга из БД: {e}")
+        logger.error(f"❌ Ошибка проверки уведомления о погоде: {e}")
+        return False
 
-def was_item_sent_to_user(user_id: int, item_name: str, quantity: int, update_id: str) -> bool:
+def was_item_sent_in_this_update(item_name: str, quantity: int, update_id: str) -> bool:
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT COUNT(*) FROM user_sent_items WHERE user_id = ? AND item_name = ? AND quantity = ? AND update_id = ?",
-            (user_id, item_name, quantity, update_id)
-        )
-        count = cur.fetchone()[0]
-        conn.close()
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT COUNT(*) FROM sent_items WHERE item_name = ? AND quantity = ? AND update_id = ?",
+                (item_name, quantity, update_id)
+            )
+            count = cur.fetchone()[0]
         return count > 0
     except Exception as e:
-        logger.error(f"❌ Ошибка проверки отправленного предмета: {e}")
+        logger.error(f"❌ Ошибка проверки update_id: {e}")
         return False
 
-def mark_item_sent_to_user(user_id: int, item_name: str, quantity: int, update_id: str):
+SQL_OUTBOX_INSERT = (
+    "INSERT INTO outbox (id, chat_id, text, parse_mode, photo, created_at) VALUES (?, ?, ?, ?, ?, ?)"
+)
+SQL_OUTBOX_ACK = "DELETE FROM outbox WHERE id = ?"
+
+def load_outbox() -> List[tuple]:
+    """Неподтверждённые сообщения outbox в порядке постановки"""
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT OR IGNORE INTO user_sent_items (user_id, item_name, quantity, sent_at, update_id) VALUES (?, ?, ?, ?, ?)",
-            (user_id, item_name, quantity, datetime.now().isoformat(), update_id)
-        )
-        conn.commit()
-        conn.close()
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT id, chat_id, text, parse_mode, photo FROM outbox ORDER BY id")
+            return cur.fetchall()
     except Exception as e:
-        logger.error(f"❌ Ошибка отметки отправленного предмета: {e}")
+        logger.error(f"❌ Ошибка загрузки outbox: {e}")
+        return []
 
-def was_item_sent(chat_id: int, item_name: str, quantity: int, update_id: str) -> bool:
+SQL_DEAD_LETTER_INSERT = (
+    "INSERT INTO dead_letters (chat_id, text, parse_mode, photo, cause, error, attempts, created_at, lane) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+SQL_DEAD_LETTER_DELETE = "DELETE FROM dead_letters WHERE id = ?"
+
+def get_dead_letter_counts() -> Dict[str, int]:
+    """Количество недоставленных сообщений по причине"""
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT COUNT(*) FROM sent_items WHERE chat_id = ? AND item_name = ? AND quantity = ? AND update_id = ?",
-            (chat_id, item_name, quantity, update_id)
-        )
-        count = cur.fetchone()[0]
-        conn.close()
-        return count > 0
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT cause, COUNT(*) FROM dead_letters GROUP BY cause")
+            return dict(cur.fetchall())
     except Exception as e:
-        logger.error(f"❌ Ошибка проверки отправленного: {e}")
-        return False
+        logger.error(f"❌ Ошибка подсчёта недоставленных сообщений: {e}")
+        return {}
 
-def mark_item_sent(chat_id: int, item_name: str, quantity: int, update_id: str):
+def get_dead_letter_max_id() -> int:
+    with db_pool.connection() as conn:
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM dead_letters").fetchone()[0]
+
+def load_dead_letters(after_id: int, until_id: int, limit: int) -> List[tuple]:
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT OR IGNORE INTO sent_items (chat_id, item_name, quantity, update_id, sent_at) VALUES (?, ?, ?, ?, ?)",
-            (chat_id, item_name, quantity, update_id, datetime.now().isoformat())
-        )
-        conn.commit()
-        conn.close()
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT id, chat_id, text, parse_mode, photo, lane FROM dead_letters WHERE id > ? AND id <= ? "
+                "ORDER BY id LIMIT ?",
+                (after_id, until_id, limit)
+            )
+            return cur.fetchall()
     except Exception as e:
-        logger.error(f"❌ Ошибка отметки отправленного: {e}")
+        logger.error(f"❌ Ошибка загрузки недоставленных сообщений: {e}")
+        return []
 
-def was_weather_notification_sent(weather_type: str, status: str, update_id: str) -> bool:
+SQL_MEDIA_CACHE_SAVE = "INSERT OR REPLACE INTO media_cache (url, file_id, updated_at) VALUES (?, ?, ?)"
+SQL_MEDIA_CACHE_DELETE = "DELETE FROM media_cache WHERE url = ?"
+
+def load_media_cache() -> Dict[str, str]:
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT COUNT(*) FROM weather_notifications WHERE weather_type = ? AND status = ? AND update_id = ?",
-            (weather_type, status, update_id)
-        )
-        count = cur.fetchone()[0]
-        conn.close()
-        return count > 0
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT url, file_id FROM media_cache")
+            return dict(cur.fetchall())
     except Exception as e:
-        logger.error(f"❌ Ошибка проверки уведомления о погоде: {e}")
-        return False
+        logger.error(f"❌ Ошибка загрузки кэша картинок: {e}")
+        return {}
 
-def mark_weather_notification_sent(weather_type: str, status: str, update_id: str):
+def get_outbox_max_id() -> int:
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT OR IGNORE INTO weather_notifications (weather_type, status, update_id, sent_at) VALUES (?, ?, ?, ?)",
-            (weather_type, status, update_id, datetime.now().isoformat())
-        )
-        conn.commit()
-        conn.close()
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT COALESCE(MAX(id), 0) FROM outbox")
+            return cur.fetchone()[0]
     except Exception as e:
-        logger.error(f"❌ Ошибка отметки уведомления о погоде: {e}")
+        logger.error(f"❌ Ошибка чтения outbox: {e}")
+        return 0
 
-def was_item_sent_in_this_update(item_name: str, quantity: int, update_id: str) -> bool:
+def create_campaign(conn: sqlite3.Connection, admin_id: int, text: str, user_ids: List[int],
+                    progress_chat_id: int, progress_message_id: int) -> int:
+    """Создаёт запись рассылки и строку доставки на каждого получателя (через storage.transaction)"""
+    now = datetime.now().isoformat()
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO mailing_history (admin_id, text, sent_at, success_count, failed_count, total_count, "
+        "status, progress_chat_id, progress_message_id, updated_at) VALUES (?, ?, ?, 0, 0, ?, 'running', ?, ?, ?)",
+        (admin_id, text, now, len(user_ids), progress_chat_id, progress_message_id, now)
+    )
+    campaign_id = cur.lastrowid
+    cur.executemany(
+        "INSERT OR IGNORE INTO mailing_deliveries (campaign_id, user_id, status) VALUES (?, ?, 'pending')",
+        [(campaign_id, user_id) for user_id in user_ids]
+    )
+    return campaign_id
+
+def get_pending_deliveries(campaign_id: int, after_user_id: int, limit: int) -> List[int]:
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT COUNT(*) FROM sent_items WHERE item_name = ? AND quantity = ? AND update_id = ?",
-            (item_name, quantity, update_id)
-        )
-        count = cur.fetchone()[0]
-        conn.close()
-        return count > 0
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT user_id FROM mailing_deliveries WHERE campaign_id = ? AND user_id > ? AND status = 'pending' "
+                "ORDER BY user_id LIMIT ?",
+                (campaign_id, after_user_id, limit)
+            )
+            return [row[0] for row in cur.fetchall()]
     except Exception as e:
-        logger.error(f"❌ Ошибка проверки update_id: {e}")
-        return False
+        logger.error(f"❌ Ошибка чтения получателей рассылки {campaign_id}: {e}")
+        return []
+
+# Сообщения, стоявшие в очереди упавшего процесса, снова ждут отправки
+SQL_REQUEUE_UNFINISHED_DELIVERIES = (
+    "UPDATE mailing_deliveries SET status = 'pending' WHERE status = 'queued' AND campaign_id IN "
+    "(SELECT id FROM mailing_history WHERE status IN ('running', 'paused'))"
+)
 
-def mark_item_sent_for_update(item_name: str, quantity: int, update_id: str):
+def load_unfinished_campaigns() -> List[Dict]:
+    """Рассылки в статусе running/paused вместе с фактическими счётчиками доставок"""
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT OR IGNORE INTO sent_items (chat_id, item_name, quantity, update_id, sent_at) VALUES (?, ?, ?, ?, ?)",
-            (0, item_name, quantity, update_id, datetime.now().isoformat())
-        )
-        conn.commit()
-        conn.close()
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT id, admin_id, text, total_count, status, progress_chat_id, progress_message_id "
+                "FROM mailing_history WHERE status IN ('running', 'paused') ORDER BY id"
+            )
+            campaigns = [
+                {
+                    'id': row[0], 'admin_id': row[1], 'text': row[2], 'total': row[3] or 0, 'status': row[4],
+                    'progress_chat_id': row[5], 'progress_message_id': row[6]
+                }
+                for row in cur.fetchall()
+            ]
+            for campaign in campaigns:
+                cur.execute(
+                    "SELECT status, COUNT(*) FROM mailing_deliveries WHERE campaign_id = ? GROUP BY status",
+                    (campaign['id'],)
+                )
+                counts = dict(cur.fetchall())
+                campaign['success'] = counts.get('sent', 0)
+                campaign['failed'] = counts.get('failed', 0)
+            return campaigns
     except Exception as e:
-        logger.error(f"❌ Ошибка отметки update_id: {e}")
+        logger.error(f"❌ Ошибка загрузки незавершённых рассылок: {e}")
+        return []
+
+# ========== АСИНХРОННОЕ ХРАНИЛИЩЕ ==========
+
+DB_READ_THREADS = max(1, DB_POOL_SIZE - 1)
+DB_WRITE_BATCH_SIZE = 500
+
+class AsyncStorage:
+    """Неблокирующий фасад над SQLite для кода в event loop.
+
+    Чтения выполняются в пуле потоков. Все записи уходят в один поток-писатель,
+    который собирает накопившиеся операции в одну транзакцию (group commit)
+    и завершает future каждой операции после коммита.
+    """
+
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+        self.commits = 0
+        self.statements_written = 0
+        self._read_executor = ThreadPoolExecutor(max_workers=DB_READ_THREADS, thread_name_prefix="db-read")
+        self._writes: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._writer_lock = threading.Lock()
+        # Ошибка, на которой упал поток-писатель: после неё записи сразу завершаются с ошибкой
+        self.writer_error: Optional[Exception] = None
+
+    def start(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+                self._writer.start()
+
+    def close(self):
+        with self._writer_lock:
+            writer, self._writer = self._writer, None
+        if writer:
+            self._writes.put(None)
+            writer.join()
+        self._read_executor.shutdown(wait=True)
+
+    async def read(self, func, *args):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._read_executor, func, *args)
+        finally:
+            metrics.observe('bot_db_seconds', time.perf_counter() - started, op='read')
+
+    def write(self, sql: str, params: tuple = ()) -> asyncio.Future:
+        return self.write_many(sql, [params])
+
+    def write_many(self, sql: str, rows) -> asyncio.Future:
+        """Ставит запись в очередь писателя; future завершается после коммита"""
+        return self._enqueue(sql, list(rows))
+
+    def transaction(self, func, *args) -> asyncio.Future:
+        """Выполняет func(conn, *args) в потоке-писателе отдельной транзакцией; future получает результат.
+
+        Для записей, которым нужен результат (lastrowid, rowcount) или служебные PRAGMA.
+        """
+        return self._enqueue(func, args)
+
+    def _enqueue(self, operation, args) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # Ошибку уже залогировал писатель, ждать результат не обязательно
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.start()
+        # Под тем же замком, что и _fail_pending: запись не может проскочить в очередь мёртвого писателя
+        with self._writer_lock:
+            if self.writer_error is not None:
+                future.set_exception(self.writer_error)
+                return future
+            self._writes.put((operation, args, loop, future))
+        return future
+
+    def add_user(self, user_id: int, username: str = "") -> asyncio.Future:
+        return self.write(SQL_UPSERT_USER, (user_id, username, datetime.now().isoformat()))
+    
+    def update_user_setting(self, user_id: int, setting: str, value: Any) -> Optional[asyncio.Future]:
+        statement = user_setting_statement(user_id, setting, value)
+        if statement:
+            return self.write(*statement)
+        return None
 
-def get_stats() -> Dict:
+    def mark_items_sent_to_users(self, rows: List[Tuple[int, str, int]], update_id: str) -> asyncio.Future:
+        sent_at = datetime.now().isoformat()
+        return self.write_many(
+            SQL_MARK_ITEM_SENT_TO_USER,
+            [(user_id, item_name, quantity, sent_at, update_id) for user_id, item_name, quantity in rows]
+        )
+
+    def mark_item_sent_for_update(self, item_name: str, quantity: int, update_id: str) -> asyncio.Future:
+        return self.write(SQL_MARK_ITEM_SENT, (0, item_name, quantity, update_id, datetime.now().isoformat()))
+
+    def mark_weather_notification_sent(self, weather_type: str, status: str, update_id: str) -> asyncio.Future:
+        return self.write(SQL_MARK_WEATHER_SENT, (weather_type, status, update_id, datetime.now().isoformat()))
+
+    def _writer_loop(self):
+        conn = None
+        try:
+            conn = self.pool.open_connection()
+            running = True
+            while running:
+                item = self._writes.get()
+                if item is None:
+                    break
+                batch = []
+                while True:
+                    if callable(item[0]):
+                        # Транзакция с функцией идёт отдельно, после уже собранных записей
+                        if batch:
+                            self._commit_batch(conn, batch)
+                            batch = []
+                        self._run_transaction(conn, item)
+                    else:
+                        batch.append(item)
+                    if len(batch) >= DB_WRITE_BATCH_SIZE:
+                        break
+                    try:
+                        item = self._writes.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        running = False
+                        break
+                if batch:
+                    self._commit_batch(conn, batch)
+        except Exception as e:
+            logger.critical(f"❌ Поток записи в БД остановлен: {e}", exc_info=True)
+            self._fail_pending(e)
+        finally:
+            if conn is not None:
+                conn.close()
+    
+    def _fail_pending(self, error: Exception):
+        """Завершает ошибкой всё, что ждёт в очереди, и все будущие записи"""
+        with self._writer_lock:
+            self.writer_error = error
+            while True:
+                try:
+                    item = self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    self._resolve(item[2], item[3], error)
+
+    def _commit_batch(self, conn: sqlite3.Connection, batch: List[tuple]):
+        started = time.perf_counter()
+        try:
+            for sql, rows, _, _ in batch:
+                conn.executemany(sql, rows)
+            conn.commit()
+            metrics.observe('bot_db_seconds', time.perf_counter() - started, op='commit')
+            self.commits += 1
+            self.statements_written += len(batch)
+            for _, _, loop, future in batch:
+                self._resolve(loop, future, None)
+            return
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"❌ Ошибка группового коммита ({len(batch)} операций): {e}")
+
+        # Повторяем по одной, чтобы ошибочная операция не потянула за собой остальные
+        for sql, rows, loop, future in batch:
+            try:
+                conn.executemany(sql, rows)
+                conn.commit()
+                self.commits += 1
+                self.statements_written += 1
+                self._resolve(loop, future, None)
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"❌ Ошибка записи в БД: {e}")
+                self._resolve(loop, future, e)
+
+    def _run_transaction(self, conn: sqlite3.Connection, item: tuple):
+        func, args, loop, future = item
+        started = time.perf_counter()
+        try:
+            result = func(conn, *args)
+            conn.commit()
+            metrics.observe('bot_db_seconds', time.perf_counter() - started, op='commit')
+            self.commits += 1
+            self.statements_written += 1
+            self._resolve(loop, future, None, result)
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"❌ Ошибка транзакции {getattr(func, '__name__', func)}: {e}")
+            self._resolve(loop, future, e)
+
+    @staticmethod
+    def _resolve(loop: asyncio.AbstractEventLoop, future: asyncio.Future, error: Optional[Exception], result=None):
+        def _set():
+            if future.done():
+                return
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        try:
+            loop.call_soon_threadsafe(_set)
+        except RuntimeError:
+            pass
+
+storage = AsyncStorage(db_pool)
+
+# ========== ХРАНЕНИЕ ИСТОРИИ ==========
+
+RETENTION_TABLES = ('user_sent_items', 'sent_items', 'weather_notifications')
+
+def delete_expired_rows(conn: sqlite3.Connection, table: str, cutoff: str, limit: int) -> int:
+    """Одна пачка чистки (через storage.transaction); отдаёт число удалённых строк"""
+    return conn.execute(
+        f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE sent_at < ? LIMIT ?)",
+        (cutoff, limit)
+    ).rowcount
+
+def get_database_size() -> Tuple[int, int]:
+    """Размер файла БД и WAL в байтах"""
+    with db_pool.connection() as conn:
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        
-        cur.execute("SELECT COUNT(*) FROM users")
-        users_count = cur.fetchone()[0]
-        
-        cur.execute("SELECT COUNT(*) FROM mandatory_channels")
-        op_count = cur.fetchone()[0]
-        
-        cur.execute("SELECT COUNT(*) FROM posting_channels")
-        post_count = cur.fetchone()[0]
-        
-        cur.execute("SELECT COUNT(*) FROM sent_items")
-        sent_count = cur.fetchone()[0]
-        
-        cur.execute("SELECT COUNT(*) FROM user_sent_items")
-        user_sent_count = cur.fetchone()[0]
-        
-        conn.close()
-        
-        return {
-            'users': users_count,
-            'op_channels': op_count,
-            'posting_channels': post_count,
-            'sent_notifications': sent_count,
-            'user_sent_items': user_sent_count
-        }
-    except Exception as e:
-        logger.error(f"❌ Ошибка получения статистики: {e}")
-        return {
-            'users': 0,
-            'op_channels': 0,
-            'posting_channels': 0,
-            'sent_notifications': 0,
-            'user_sent_items': 0
-        }
+        wal_size = os.path.getsize(DB_PATH + "-wal")
+    except OSError:
+        wal_size = 0
+    return page_count * page_size, wal_size
 
-# ========== ОГРАНИЧИТЕЛЬ ЗАПРОСОВ ==========
+def compact_database(conn: sqlite3.Connection, vacuum_pages: int = RETENTION_VACUUM_PAGES) -> int:
+    """Возвращает свободные страницы файлу и обрезает WAL; отдаёт число оставшихся свободных страниц.
+
+    Пишет в файл, поэтому выполняется в потоке-писателе через storage.transaction.
+    """
+    # execute() делает один шаг и освобождает одну страницу, executescript доводит pragma до конца
+    conn.executescript(f"PRAGMA incremental_vacuum({int(vacuum_pages)});")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+@dataclass
+class RetentionReport:
+    finished_at: float
+    rows: Dict[str, int]
+    db_bytes_before: int
+    db_bytes_after: int
+    wal_bytes_before: int
+    wal_bytes_after: int
+    freelist_pages: int
+    seconds: float
+    
+    @property
+    def rows_deleted(self) -> int:
+        return sum(self.rows.values())
+    
+    @property
+    def bytes_reclaimed(self) -> int:
+        return max(0, self.db_bytes_before - self.db_bytes_after) + max(0, self.wal_bytes_before - self.wal_bytes_after)
+
+class RetentionJob:
+    """Фоновая чистка истории отправок старше HISTORY_RETENTION_HOURS.
 
-class RateLimiter:
-    def __init__(self, max_calls_per_second=30):
-        self.max_calls = max_calls_per_second
-        self.calls = []
-        self.lock = asyncio.Lock()
+    Удаляет пачками по RETENTION_BATCH_SIZE через общий писатель, поэтому между
+    пачками проходят обычные записи. После чистки - incremental vacuum и
+    wal_checkpoint(TRUNCATE), чтобы файл БД и WAL действительно уменьшились.
+    """
+    
+    def __init__(self, storage: AsyncStorage, retention_hours: float = HISTORY_RETENTION_HOURS,
+                 batch_size: int = RETENTION_BATCH_SIZE):
+        self.storage = storage
+        self.retention_hours = retention_hours
+        self.batch_size = batch_size
+        self.last_report: Optional[RetentionReport] = None
+        self.total_rows_deleted = 0
+        self.total_bytes_reclaimed = 0
+        self._lock = asyncio.Lock()
+    
+    def cutoff(self) -> str:
+        return (datetime.now() - timedelta(hours=self.retention_hours)).isoformat()
     
-    async def acquire(self):
-        async with self.lock:
-            now = time.time()
-            self.calls = [t for t in self.calls if now - t < 1.0]
+    async def run_once(self) -> RetentionReport:
+        async with self._lock:
+            started = time.monotonic()
+            cutoff = self.cutoff()
+            db_before, wal_before = await self.storage.read(get_database_size)
+            
+            rows = {}
+            for table in RETENTION_TABLES:
+                deleted = 0
+                # Каждая пачка - отдельная короткая транзакция писателя; неполная пачка - последняя
+                while True:
+                    count = await self.storage.transaction(delete_expired_rows, table, cutoff, self.batch_size)
+                    deleted += count
+                    if count < self.batch_size:
+                        break
+                rows[table] = deleted
+            
+            freelist = await self.storage.transaction(compact_database)
+            db_after, wal_after = await self.storage.read(get_database_size)
             
-            if len(self.calls) >= self.max_calls:
-                wait_time = 1.0 - (now - self.calls[0])
-                if wait_time > 0:
-                    await asyncio.sleep(wait_time)
-                self.calls.pop(0)
+            report = RetentionReport(
+                finished_at=time.time(), rows=rows,
+                db_bytes_before=db_before, db_bytes_after=db_after,
+                wal_bytes_before=wal_before, wal_bytes_after=wal_after,
+                freelist_pages=freelist, seconds=time.monotonic() - started
+            )
+            self.last_report = report
+            self.total_rows_deleted += report.rows_deleted
+            self.total_bytes_reclaimed += report.bytes_reclaimed
             
-            self.calls.append(now)
+            details = ", ".join(f"{table}: {count}" for table, count in rows.items())
+            logger.info(
+                f"🧹 Чистка истории старше {self.retention_hours:.0f} ч: удалено {report.rows_deleted} записей ({details}), "
+                f"освобождено {report.bytes_reclaimed / 1024:.0f} КБ, БД {db_after / 1024:.0f} КБ, "
+                f"WAL {wal_after / 1024:.0f} КБ, {report.seconds:.1f} сек"
+            )
+            return report
+    
+    async def run_forever(self, interval: float = RETENTION_INTERVAL):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"❌ Ошибка чистки истории: {e}", exc_info=True)
+            await asyncio.sleep(interval)
+    
+    def summary(self) -> str:
+        report = self.last_report
+        if not report:
+            return f"окно {self.retention_hours:.0f} ч, чистка ещё не запускалась"
+        finished = datetime.fromtimestamp(report.finished_at, MSK_TIMEZONE).strftime('%H:%M')
+        return (
+            f"окно {self.retention_hours:.0f} ч, в {finished} удалено {report.rows_deleted} записей, "
+            f"освобождено {report.bytes_reclaimed / 1024:.0f} КБ; всего {self.total_rows_deleted} / "
+            f"{self.total_bytes_reclaimed / 1024 / 1024:.1f} МБ"
+        )
+
+# ========== ОГРАНИЧИТЕЛЬ ЗАПРОСОВ ==========
+
+TELEGRAM_GLOBAL_RATE = 30        # сообщений в секунду на бота
+TELEGRAM_GROUP_RATE = 20 / 60    # сообщений в секунду в одну группу или канал
+TELEGRAM_GROUP_BURST = 5
+RETRY_AFTER_MAX_ATTEMPTS = 5
+
+# Результат отправки
+SEND_OK = 'sent'
+SEND_DEAD = 'dead'            # чат недоступен навсегда
+SEND_INVALID = 'invalid'      # Telegram отверг само сообщение
+SEND_TRANSIENT = 'transient'  # сеть или таймаут
+SEND_FAILED = 'failed'        # прочее
+SEND_RETRY_AFTER = 'retry_after'  # Telegram попросил подождать
+
+# Фрагмент текста ошибки -> статус пользователя
+DEAD_CHAT_ERRORS = (
+    ("bot was blocked by the user", 'blocked'),
+    ("user is deactivated", 'deactivated'),
+    ("chat not found", 'not_found'),
+    ("bot can't initiate conversation", 'blocked'),
+)
+
+def classify_send_error(error: Exception) -> Tuple[str, Optional[str]]:
+    """(результат, статус пользователя) для ошибки отправки"""
+    if isinstance(error, RetryAfter):
+        return SEND_RETRY_AFTER, None
+    # BadRequest наследуется от NetworkError, поэтому проверяется первым
+    if isinstance(error, (Forbidden, BadRequest)):
+        description = str(error).lower()
+        for fragment, status in DEAD_CHAT_ERRORS:
+            if fragment in description:
+                return SEND_DEAD, status
+        if isinstance(error, Forbidden):
+            return SEND_DEAD, 'blocked'
+        return SEND_INVALID, None
+    if isinstance(error, (TimedOut, NetworkError)):
+        return SEND_TRANSIENT, None
+    return SEND_FAILED, None
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def wait_time(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    def consume(self):
+        self.tokens -= 1
+
+class TelegramRateLimiter:
+    """Общий token bucket бота, бюджеты групп/каналов и общая пауза после RetryAfter.
+    
+    Проверка и списание токена происходят без await, поэтому блокировка не нужна,
+    а ожидающие воркеры спят независимо друг от друга.
+    """
+    
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, group_rate: float = TELEGRAM_GROUP_RATE,
+                 group_burst: float = TELEGRAM_GROUP_BURST):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.paused_until = 0.0
+        self.total_wait = 0.0
+    
+    def _chat_bucket(self, chat_id) -> Optional[TokenBucket]:
+        # Отдельный бюджет нужен только группам и каналам (отрицательные ID)
+        if not isinstance(chat_id, int) or chat_id >= 0:
+            return None
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.group_rate, self.group_burst)
+        return bucket
+    
+    def wait_time(self, chat_id=None) -> float:
+        now = time.monotonic()
+        wait = max(0.0, self.paused_until - now, self.global_bucket.wait_time(now))
+        bucket = self._chat_bucket(chat_id)
+        if bucket:
+            wait = max(wait, bucket.wait_time(now))
+        return wait
+    
+    async def acquire(self, chat_id=None) -> float:
+        """Ждёт свободного слота для чата и возвращает время ожидания"""
+        waited = 0.0
+        while True:
+            wait = self.wait_time(chat_id)
+            if wait <= 0:
+                self.global_bucket.consume()
+                bucket = self._chat_bucket(chat_id)
+                if bucket:
+                    bucket.consume()
+                self.total_wait += waited
+                return waited
+            await asyncio.sleep(wait)
+            waited += wait
+    
+    def pause(self, seconds: float):
+        """Общая пауза для всех воркеров после RetryAfter от Telegram"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    
+    def wait_times(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        chats = {}
+        for chat_id, bucket in self.chat_buckets.items():
+            wait = bucket.wait_time(now)
+            if wait > 0:
+                chats[chat_id] = wait
+        return {
+            'paused': max(0.0, self.paused_until - now),
+            'global': self.global_bucket.wait_time(now),
+            'chats': chats
+        }
 
 # ========== КЛАССЫ ==========
 
@@ -729,28 +1739,54 @@ class ItemSettings:
     def from_dict(cls, data):
         return cls(data.get('enabled', True))
 
-@dataclass
 class UserSettings:
-    user_id: int
-    username: str = ""
-    notifications_enabled: bool = False
-    seeds: Dict[str, ItemSettings] = field(default_factory=dict)
-    gear: Dict[str, ItemSettings] = field(default_factory=dict)
-    weather: Dict[str, ItemSettings] = field(default_factory=dict)
-    is_admin: bool = False
-    
-    def __post_init__(self):
-        db_settings = get_user_settings(self.user_id)
-        self.notifications_enabled = db_settings['notifications_enabled']
-        
-        for seed in SEEDS_LIST:
-            self.seeds[seed] = ItemSettings(enabled=db_settings['seeds'].get(seed, True))
-        for gear in GEAR_LIST:
-            self.gear[gear] = ItemSettings(enabled=db_settings['gear'].get(gear, True))
-        for weather in WEATHER_LIST:
-            self.weather[weather] = ItemSettings(enabled=db_settings['weather'].get(weather, True))
-        
-        self.is_admin = (self.user_id == ADMIN_ID)
+    """Настройки пользователя; включённые предметы хранятся битами одной маски (см. ITEM_BITS)"""
+    
+    __slots__ = ('user_id', 'username', 'notifications_enabled', 'items_mask', 'status', 'is_admin')
+    
+    def __init__(self, user_id: int, username: str = "", notifications_enabled: bool = True,
+                 items_mask: int = ALL_ITEMS_MASK, status: str = USER_ACTIVE):
+        self.user_id = user_id
+        self.username = username
+        self.notifications_enabled = notifications_enabled
+        self.items_mask = items_mask
+        self.status = status
+        self.is_admin = (user_id == ADMIN_ID)
+    
+    @property
+    def is_active(self) -> bool:
+        return self.status == USER_ACTIVE
+    
+    @property
+    def receives_notifications(self) -> bool:
+        """Уведомления включены и чат доступен"""
+        return self.notifications_enabled and self.status == USER_ACTIVE
+    
+    def is_item_enabled(self, item_name: str) -> bool:
+        return bool(self.items_mask & ITEM_BITS.get(item_name, 0))
+    
+    def set_item_enabled(self, item_name: str, enabled: bool):
+        bit = ITEM_BITS.get(item_name, 0)
+        if enabled:
+            self.items_mask |= bit
+        else:
+            self.items_mask &= ~bit
+    
+    def _items_view(self, items: List[str]) -> Dict[str, ItemSettings]:
+        return {item: ItemSettings(self.is_item_enabled(item)) for item in items}
+    
+    # Представления в старом формате; это копии, менять настройки через set_item_enabled
+    @property
+    def seeds(self) -> Dict[str, ItemSettings]:
+        return self._items_view(SEEDS_LIST)
+    
+    @property
+    def gear(self) -> Dict[str, ItemSettings]:
+        return self._items_view(GEAR_LIST)
+    
+    @property
+    def weather(self) -> Dict[str, ItemSettings]:
+        return self._items_view(WEATHER_LIST)
     
     def to_dict(self):
         return {
@@ -767,134 +1803,1050 @@ class UserSettings:
         settings = cls(data['user_id'], data.get('username', ''))
         settings.notifications_enabled = data.get('notifications_enabled', False)
         
-        for k, v in data.get('seeds', {}).items():
-            if k in SEEDS_LIST:
-                settings.seeds[k] = ItemSettings.from_dict(v)
-        for k, v in data.get('gear', {}).items():
-            if k in GEAR_LIST:
-                settings.gear[k] = ItemSettings.from_dict(v)
-        for k, v in data.get('weather', {}).items():
-            if k in WEATHER_LIST:
-                settings.weather[k] = ItemSettings.from_dict(v)
-        
-        settings.__post_init__()
+        for group, items in (('seeds', SEEDS_LIST), ('gear', GEAR_LIST), ('weather', WEATHER_LIST)):
+            for k, v in data.get(group, {}).items():
+                if k in items:
+                    settings.set_item_enabled(k, ItemSettings.from_dict(v).enabled)
+        
         return settings
 
+class SubscriberIndex:
+    """Обратный индекс: предмет -> активные пользователи, у которых он включён вместе с уведомлениями"""
+    
+    def __init__(self):
+        self._subscribers: Dict[str, Set[int]] = {
+            item: set() for item in SEEDS_LIST + GEAR_LIST + WEATHER_LIST
+        }
+    
+    def build(self, users: List[UserSettings]):
+        for subscribers in self._subscribers.values():
+            subscribers.clear()
+        for settings in users:
+            self.refresh_user(settings)
+    
+    def refresh_user(self, settings: UserSettings, items: Optional[List[str]] = None):
+        """Пересчитывает записи пользователя (по всем предметам или только по указанным)"""
+        for item in items if items is not None else self._subscribers:
+            subscribers = self._subscribers.get(item)
+            if subscribers is None:
+                continue
+            if settings.receives_notifications and settings.is_item_enabled(item):
+                subscribers.add(settings.user_id)
+            else:
+                subscribers.discard(settings.user_id)
+    
+    def subscribers(self, item_name: str) -> Set[int]:
+        return self._subscribers.get(item_name, set())
+    
+    def audience(self, item_names) -> Set[int]:
+        """Все пользователи, которым интересен хотя бы один предмет из апдейта"""
+        result = set()
+        for item_name in item_names:
+            result |= self.subscribers(item_name)
+        return result
+
+class ColumnarUserTable:
+    """Пользователи в колонках NumPy: id, флаг уведомлений и маска предметов.
+
+    Аудитория апдейта выбирается одной векторной операцией над масками, а группы
+    получателей - сортировкой по пересечению маски пользователя с маской апдейта.
+    """
+    
+    def __init__(self, capacity: int = 1024):
+        self.size = 0
+        self.user_ids = np.zeros(capacity, dtype=np.int64)
+        self.enabled = np.zeros(capacity, dtype=bool)
+        self.masks = np.zeros(capacity, dtype=np.uint64)
+        self._rows: Dict[int, int] = {}
+    
+    def _reserve(self, needed: int):
+        capacity = len(self.user_ids)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name in ('user_ids', 'enabled', 'masks'):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+    
+    def build(self, users: List[UserSettings]):
+        self.size = 0
+        self._reserve(len(users))
+        count = len(users)
+        self.user_ids[:count] = [settings.user_id for settings in users]
+        self.enabled[:count] = [settings.receives_notifications for settings in users]
+        self.masks[:count] = [settings.items_mask for settings in users]
+        self._rows = {settings.user_id: row for row, settings in enumerate(users)}
+        self.size = count
+    
+    def refresh_user(self, settings: UserSettings):
+        row = self._rows.get(settings.user_id)
+        if row is None:
+            row = self.size
+            self._reserve(row + 1)
+            self.user_ids[row] = settings.user_id
+            self._rows[settings.user_id] = row
+            self.size += 1
+        self.enabled[row] = settings.receives_notifications
+        self.masks[row] = settings.items_mask
+    
+    def select(self, update_mask: int) -> Tuple["np.ndarray", "np.ndarray"]:
+        """Получатели апдейта и их сигнатуры - включённые у них предметы апдейта битами"""
+        signatures = self.masks[:self.size] & np.uint64(update_mask)
+        selected = self.enabled[:self.size] & (signatures != 0)
+        return self.user_ids[:self.size][selected], signatures[selected]
+    
+    def groups(self, update_mask: int) -> Dict[int, "np.ndarray"]:
+        """Сигнатура -> id получателей с этой сигнатурой"""
+        user_ids, signatures = self.select(update_mask)
+        if not len(user_ids):
+            return {}
+        order = np.argsort(signatures, kind='stable')
+        user_ids, signatures = user_ids[order], signatures[order]
+        unique, starts = np.unique(signatures, return_index=True)
+        ends = np.append(starts[1:], len(user_ids))
+        return {int(signature): user_ids[start:end] for signature, start, end in zip(unique, starts, ends)}
+
 class UserManager:
     def __init__(self):
         self.users: Dict[int, UserSettings] = {}
+        self.index = SubscriberIndex()
+        self.columns = ColumnarUserTable() if np is not None and COLUMNAR_USERS else None
         self.load_users()
     
     def load_users(self):
-        user_ids = get_all_users()
-        for user_id in user_ids:
-            self.users[user_id] = UserSettings(user_id)
-        logger.info(f"📥 Загружено {len(self.users)} пользователей из БД")
+        started = time.perf_counter()
+        try:
+            for user_id, username, notifications_enabled, mask, status in iter_user_settings_rows():
+                self.users[user_id] = UserSettings(user_id, username, notifications_enabled, mask, status)
+        except Exception as e:
+            logger.error(f"❌ Ошибка загрузки пользователей: {e}")
+        self.index.build(list(self.users.values()))
+        if self.columns is not None:
+            self.columns.build(list(self.users.values()))
+        elapsed = time.perf_counter() - started
+        logger.info(f"📥 Загружено {len(self.users)} пользователей из БД за {elapsed:.2f} сек")
     
     def get_user(self, user_id: int, username: str = "") -> UserSettings:
+        # Все пользователи загружены при старте, поэтому отсутствующий здесь - новый:
+        # настройки по умолчанию, а запись в БД уходит писателю, не блокируя event loop
         if user_id not in self.users:
-            add_user_to_db(user_id, username)
             self.users[user_id] = UserSettings(user_id, username)
+            self.index.refresh_user(self.users[user_id])
+            if self.columns is not None:
+                self.columns.refresh_user(self.users[user_id])
+            storage.add_user(user_id, username)
         elif username and self.users[user_id].username != username:
             self.users[user_id].username = username
-            add_user_to_db(user_id, username)
+            storage.add_user(user_id, username)
         return self.users[user_id]
     
     def get_all_users(self) -> List[int]:
         return list(self.users.keys())
     
+    def update_setting(self, settings: UserSettings, setting: str, value: Any):
+        """Меняет настройку в памяти, в индексе подписчиков и в БД"""
+        if setting == 'notifications_enabled':
+            settings.notifications_enabled = bool(value)
+            self.index.refresh_user(settings)
+        else:
+            item_name = setting.replace('seed_', '').replace('gear_', '').replace('weather_', '')
+            settings.set_item_enabled(item_name, bool(value))
+            self.index.refresh_user(settings, [item_name])
+        if self.columns is not None:
+            self.columns.refresh_user(settings)
+        storage.update_user_setting(settings.user_id, setting, value)
+    
+    def set_status(self, user_id: int, status: str):
+        """Помечает чат недоступным (или снова активным) и убирает его из индекса подписчиков"""
+        settings = self.users.get(user_id)
+        if settings is None or settings.status == status:
+            return
+        previous, settings.status = settings.status, status
+        self.index.refresh_user(settings)
+        if self.columns is not None:
+            self.columns.refresh_user(settings)
+        storage.write(SQL_SET_USER_STATUS, (status, datetime.now().isoformat(), user_id))
+        if status == USER_ACTIVE:
+            logger.info(f"♻️ Пользователь {user_id} снова активен (был {previous})")
+        else:
+            logger.info(f"🚫 Пользователь {user_id} недоступен ({status}), исключён из рассылок")
+    
+    def status_counts(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for settings in self.users.values():
+            counts[settings.status] = counts.get(settings.status, 0) + 1
+        return counts
+    
+    def recipient_groups(self, all_items: List[tuple], already_sent: Set[tuple],
+                         exclude: int = ADMIN_ID) -> Dict[Tuple[int, ...], List[int]]:
+        """Получатели лички, сгруппированные по набору предметов апдейта.
+
+        Ключ группы - позиции в all_items, которые пользователь ещё не получил в этом апдейте.
+        """
+        if self.columns is not None:
+            return self._columnar_groups(all_items, already_sent, exclude)
+        
+        # Аудитория апдейта - объединение подписчиков его предметов, без полного перебора пользователей
+        users = self.index.audience(name for name, _ in all_items)
+        users.discard(exclude)
+        item_subscribers = [(name, qty, self.index.subscribers(name)) for name, qty in all_items]
+        groups: Dict[Tuple[int, ...], List[int]] = {}
+        for user_id in users:
+            signature = tuple(
+                position for position, (name, qty, subscribers) in enumerate(item_subscribers)
+                if user_id in subscribers and (user_id, name, qty) not in already_sent
+            )
+            if signature:
+                groups.setdefault(signature, []).append(user_id)
+        return groups
+    
+    def _columnar_groups(self, all_items: List[tuple], already_sent: Set[tuple],
+                         exclude: int) -> Dict[Tuple[int, ...], List[int]]:
+        update_mask = items_mask(name for name, _ in all_items)
+        # Пользователи, которым часть апдейта уже ушла (повторная обработка), досчитываются по одному
+        partial = np.array(sorted({user_id for user_id, _, _ in already_sent}), dtype=np.int64)
+        groups: Dict[Tuple[int, ...], List[int]] = {}
+        for mask, user_ids in self.columns.groups(update_mask).items():
+            signature = tuple(
+                position for position, (name, _) in enumerate(all_items) if ITEM_BITS.get(name, 0) & mask
+            )
+            user_ids = user_ids[user_ids != exclude]
+            if len(partial):
+                is_partial = np.isin(user_ids, partial)
+                for user_id in user_ids[is_partial].tolist():
+                    rest = tuple(
+                        position for position in signature if (user_id, *all_items[position]) not in already_sent
+                    )
+                    if rest:
+                        groups.setdefault(rest, []).append(user_id)
+                user_ids = user_ids[~is_partial]
+            if len(user_ids):
+                groups.setdefault(signature, []).extend(user_ids.tolist())
+        return groups
+    
     def save_users(self):
         pass
 
 # ========== ОПТИМИЗИРОВАННАЯ ОЧЕРЕДЬ СООБЩЕНИЙ ==========
 
+@dataclass(frozen=True)
+class RetryPolicy:
+    max_attempts: int
+    base_delay: float
+    max_delay: float
+    
+    def delay(self, attempt: int) -> float:
+        """Экспоненциальная пауза перед попыткой attempt + 1 со случайным разбросом в верхней половине"""
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+# Что повторять и как; dead и invalid не повторяются - результат не изменится
+RETRY_POLICIES = {
+    SEND_RETRY_AFTER: RetryPolicy(max_attempts=RETRY_AFTER_MAX_ATTEMPTS, base_delay=1.0, max_delay=30.0),
+    SEND_TRANSIENT: RetryPolicy(max_attempts=5, base_delay=2.0, max_delay=120.0),
+    SEND_FAILED: RetryPolicy(max_attempts=3, base_delay=5.0, max_delay=120.0),
+}
+DEAD_LETTER_REPLAY_BATCH = 500
+
+# Полосы очереди: посты в каналы > личные уведомления о стоке > рассылки админа.
+# Вес - доля выборок, которую полоса получает, пока в ней есть сообщения
+LANE_REALTIME = 'realtime'
+LANE_PERSONAL = 'personal'
+LANE_MAILING = 'mailing'
+LANE_WEIGHTS = {LANE_REALTIME: 10, LANE_PERSONAL: 4, LANE_MAILING: 1}
+
+def lane_for_chat(chat_id: int) -> str:
+    """Полоса по умолчанию: каналы и группы (отрицательный id) - realtime, личка - personal"""
+    return LANE_REALTIME if chat_id < 0 else LANE_PERSONAL
+
+@dataclass
+class OutgoingMessage:
+    chat_id: int
+    text: str
+    parse_mode: str = 'HTML'
+    photo: Optional[str] = None
+    outbox_id: Optional[int] = None
+    # Итог отправки: True - доставлено, False - ошибка, None - пропущено (is_cancelled)
+    on_done: Optional[Callable[[Optional[bool]], None]] = None
+    is_cancelled: Optional[Callable[[], bool]] = None
+    attempts: int = 0
+    lane: str = LANE_PERSONAL
+    enqueued_at: float = 0.0
+
+class LaneQueue:
+    """Очередь из нескольких полос со взвешенным справедливым выбором (smooth weighted round-robin).
+
+    Полоса с большим весом обслуживается чаще, но каждая непустая полоса получает свою
+    долю, поэтому пост в канал не ждёт за десятками тысяч личных сообщений, а рассылка
+    не голодает. Интерфейс - подмножество asyncio.Queue, которое нужно MessageQueue.
+    """
+    
+    def __init__(self, weights: Dict[str, int] = LANE_WEIGHTS):
+        self.weights = dict(weights)
+        self._lanes: Dict[str, deque] = {lane: deque() for lane in self.weights}
+        self._credit: Dict[str, int] = {lane: 0 for lane in self.weights}
+        self._available = asyncio.Semaphore(0)
+        self._unfinished = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
+    
+    def qsize(self) -> int:
+        return sum(len(items) for items in self._lanes.values())
+    
+    def lane_size(self, lane: str) -> int:
+        return len(self._lanes[lane])
+    
+    def put_nowait(self, message: OutgoingMessage):
+        message.enqueued_at = time.monotonic()
+        self._lanes[message.lane].append(message)
+        self._unfinished += 1
+        self._finished.clear()
+        self._available.release()
+    
+    async def put(self, message: OutgoingMessage):
+        self.put_nowait(message)
+    
+    async def get(self) -> OutgoingMessage:
+        await self._available.acquire()
+        lane = self._pick()
+        message = self._lanes[lane].popleft()
+        if not self._lanes[lane]:
+            # Опустевшая полоса не копит кредит, иначе потом заберёт несколько выборок подряд
+            self._credit[lane] = 0
+        metrics.observe('bot_queue_wait_seconds', time.monotonic() - message.enqueued_at, QUEUE_WAIT_BUCKETS, lane=lane)
+        return message
+    
+    def _pick(self) -> str:
+        best = None
+        total = 0
+        for lane, items in self._lanes.items():
+            if not items:
+                continue
+            weight = self.weights[lane]
+            self._credit[lane] += weight
+            total += weight
+            if best is None or self._credit[lane] > self._credit[best]:
+                best = lane
+        self._credit[best] -= total
+        return best
+    
+    def task_done(self):
+        self._unfinished -= 1
+        if self._unfinished <= 0:
+            self._unfinished = 0
+            self._finished.set()
+    
+    async def join(self):
+        await self._finished.wait()
+
 class MessageQueue:
-    def __init__(self):
-        self.queue = asyncio.Queue()
+    def __init__(self, durable: bool = DURABLE_OUTBOX):
+        self.queue = LaneQueue()
         self._tasks = []
         self.application = None
-        self.worker_count = 5
+        self.worker_count = MESSAGE_WORKERS
         self.sent_count = 0
         self.start_time = time.time()
-        self.batch_size = 20
-        self.rate_limiter = RateLimiter(max_calls_per_second=30)
+        self.rate_limiter = TelegramRateLimiter()
+        # Вызывается для личного чата, который больше не принимает сообщения: (chat_id, статус)
+        self.on_dead_chat: Optional[Callable[[int, str], None]] = None
+        
+        # Повторы ждут в таймерах loop.call_later, а не в воркерах, чтобы не задерживать другие чаты
+        self._retry_timers: Dict[int, asyncio.TimerHandle] = {}
+        self._replay_lock = asyncio.Lock()
+        self.retried = 0
+        self.dead_lettered = 0
+        
+        # Outbox: сообщения сначала пишутся в SQLite пачками и только после коммита
+        # попадают к воркерам; после отправки id подтверждаются пачкой DELETE
+        self.durable = durable
+        self._next_outbox_id = 0
+        self._outbox_pending: List[OutgoingMessage] = []
+        self._outbox_acks: List[int] = []
+        self._outbox_wakeup = asyncio.Event()
     
     async def start(self):
+        if self.durable:
+            await self._restore_outbox()
+            self._tasks.append(asyncio.create_task(self._outbox_flusher()))
+        
         for i in range(self.worker_count):
             task = asyncio.create_task(self._worker(i))
             self._tasks.append(task)
-        logger.warning(f"🚀 ЗАПУЩЕНО {self.worker_count} ВОРКЕРОВ")
+        logger.warning(f"🚀 ЗАПУЩЕНО {self.worker_count} ВОРКЕРОВ" + (" (outbox в SQLite)" if self.durable else ""))
     
     async def stop(self):
+        # Отложенные повторы из outbox восстановятся при следующем запуске
+        for timer in self._retry_timers.values():
+            timer.cancel()
+        self._retry_timers.clear()
         for task in self._tasks:
             task.cancel()
             try:
                 await task
             except asyncio.CancelledError:
                 pass
+        if self.durable:
+            await self._flush_outbox()
     
-    async def _worker(self, worker_id: int):
-        batch = []
+    async def put(self, chat_id: int, text: str, parse_mode: str = 'HTML', photo: Optional[str] = None,
+                  on_done: Optional[Callable[[Optional[bool]], None]] = None,
+                  is_cancelled: Optional[Callable[[], bool]] = None, lane: Optional[str] = None):
+        message = OutgoingMessage(chat_id, text, parse_mode, photo, on_done=on_done, is_cancelled=is_cancelled,
+                                  lane=lane or lane_for_chat(chat_id))
+        # Сообщения с on_done ведут своё состояние сами (например, рассылки) и в outbox не пишутся
+        if not self.durable or on_done is not None:
+            await self.queue.put(message)
+            return
+        
+        self._next_outbox_id += 1
+        message.outbox_id = self._next_outbox_id
+        self._outbox_pending.append(message)
+        if len(self._outbox_pending) >= OUTBOX_BATCH_SIZE:
+            self._outbox_wakeup.set()
+    
+    def depth(self) -> int:
+        return self.queue.qsize() + len(self._outbox_pending) + self.retry_pending()
+    
+    def retry_pending(self) -> int:
+        return len(self._retry_timers)
+    
+    def _schedule_retry(self, message: OutgoingMessage, delay: float):
+        key = id(message)
+        
+        def _requeue():
+            self._retry_timers.pop(key, None)
+            self.queue.put_nowait(message)
         
+        self._retry_timers[key] = asyncio.get_running_loop().call_later(delay, _requeue)
+    
+    def _dead_letter(self, message: OutgoingMessage, outcome: str, error: Optional[Exception]):
+        self.dead_lettered += 1
+        storage.write(SQL_DEAD_LETTER_INSERT, (
+            message.chat_id, message.text, message.parse_mode, message.photo,
+            outcome, str(error) if error else None, message.attempts, datetime.now().isoformat(), message.lane
+        ))
+        logger.error(f"📮 Чат {message.chat_id}: {message.attempts} попыток без успеха ({outcome}: {error}), сообщение в dead_letters")
+    
+    async def replay_dead_letters(self, skip: Optional[Callable[[int], bool]] = None) -> Tuple[int, int]:
+        """Возвращает недоставленные сообщения в очередь; skip(chat_id) - кого не отправлять (их письма удаляются)"""
+        replayed = skipped = 0
+        async with self._replay_lock:
+            # Только то, что было на момент нажатия: снова упавшие сообщения ждут следующего повтора
+            until_id = await storage.read(get_dead_letter_max_id)
+            after_id = 0
+            while True:
+                rows = await storage.read(load_dead_letters, after_id, until_id, DEAD_LETTER_REPLAY_BATCH)
+                if not rows:
+                    break
+                for _, chat_id, text, parse_mode, photo, lane in rows:
+                    if skip is not None and skip(chat_id):
+                        skipped += 1
+                        continue
+                    # Письма рассылки возвращаются в полосу рассылки, а не обгоняют её в личке
+                    await self.put(chat_id, text, parse_mode, photo, lane=lane)
+                    replayed += 1
+                after_id = rows[-1][0]
+                await storage.write_many(SQL_DEAD_LETTER_DELETE, [(row[0],) for row in rows])
+        logger.info(f"🔁 Повторная отправка dead_letters: {replayed} в очереди, {skipped} пропущено")
+        return replayed, skipped
+    
+    async def _restore_outbox(self):
+        self._next_outbox_id = await storage.read(get_outbox_max_id)
+        rows = await storage.read(load_outbox)
+        for outbox_id, chat_id, text, parse_mode, photo in rows:
+            self.queue.put_nowait(OutgoingMessage(chat_id, text, parse_mode, photo, outbox_id, lane=lane_for_chat(chat_id)))
+        if rows:
+            logger.warning(f"📬 Восстановлено {len(rows)} неотправленных сообщений из outbox")
+    
+    async def _outbox_flusher(self):
         while True:
             try:
-                await self.rate_limiter.acquire()
+                await asyncio.wait_for(self._outbox_wakeup.wait(), OUTBOX_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._outbox_wakeup.clear()
+            try:
+                await self._flush_outbox()
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи outbox: {e}")
+                await asyncio.sleep(1)
+    
+    async def _flush_outbox(self):
+        if self._outbox_pending:
+            batch, self._outbox_pending = self._outbox_pending, []
+            created_at = datetime.now().isoformat()
+            try:
+                await storage.write_many(
+                    SQL_OUTBOX_INSERT,
+                    [(m.outbox_id, m.chat_id, m.text, m.parse_mode, m.photo, created_at) for m in batch]
+                )
+            except Exception:
+                # Не потеряли: вернём пачку в начало и попробуем ещё раз
+                self._outbox_pending[:0] = batch
+                raise
+            # Пачка надёжно записана - отдаём её воркерам целиком
+            for message in batch:
+                self.queue.put_nowait(message)
+        
+        if self._outbox_acks:
+            acks, self._outbox_acks = self._outbox_acks, []
+            await storage.write_many(SQL_OUTBOX_ACK, [(outbox_id,) for outbox_id in acks])
+    
+    async def _worker(self, worker_id: int):
+        while True:
+            message = await self.queue.get()
+            result = False
+            retrying = False
+            try:
+                if message.is_cancelled is not None and message.is_cancelled():
+                    result = None
+                    continue
                 
-                while len(batch) < self.batch_size:
-                    try:
-                        chat_id, text, parse_mode, photo = self.queue.get_nowait()
-                        batch.append((chat_id, text, parse_mode, photo))
-                    except asyncio.QueueEmpty:
-                        break
+                message.attempts += 1
+                outcome, status, error = await self._deliver(message.chat_id, message.text, message.parse_mode, message.photo)
+                result = outcome == SEND_OK
+                if not result:
+                    metrics.inc('bot_send_errors_total', cause=outcome)
                 
-                if batch:
-                    for chat_id, text, parse_mode, photo in batch:
-                        try:
-                            if photo:
-                                await self._send_fast(chat_id, photo, text, parse_mode)
-                            else:
-                                await self._send_message_fast(chat_id, text, parse_mode)
-                            
-                            await asyncio.sleep(0.05)
-                            
-                        except Exception as e:
-                            logger.error(f"Ошибка отправки: {e}")
-                    
-                    self.sent_count += len(batch)
-                    if self.sent_count % 100 == 0:
-                        elapsed = time.time() - self.start_time
-                        speed = self.sent_count / elapsed if elapsed > 0 else 0
-                        logger.info(f"📨 {self.sent_count} сообщений, скорость {speed:.1f} msg/сек")
-                    
-                    batch.clear()
+                policy = RETRY_POLICIES.get(outcome)
+                if policy is not None and message.attempts < policy.max_attempts:
+                    delay = policy.delay(message.attempts)
+                    if isinstance(error, RetryAfter):
+                        delay = max(delay, float(error.retry_after))
+                    retrying = True
+                    self.retried += 1
+                    metrics.inc('bot_message_retries_total', cause=outcome)
+                    self._schedule_retry(message, delay)
+                    continue
                 
-                await asyncio.sleep(0.01)
+                metrics.inc('bot_messages_total', result='sent' if result else 'failed')
+                if outcome == SEND_DEAD and message.chat_id > 0 and self.on_dead_chat is not None:
+                    self.on_dead_chat(message.chat_id, status)
+                elif policy is not None:
+                    self._dead_letter(message, outcome, error)
                 
+                self.sent_count += 1
+                if self.sent_count % 100 == 0:
+                    elapsed = time.time() - self.start_time
+                    speed = self.sent_count / elapsed if elapsed > 0 else 0
+                    logger.info(f"📨 {self.sent_count} сообщений, скорость {speed:.1f} msg/сек")
+                
+            except asyncio.CancelledError:
+                # Остановка посреди отправки: не подтверждаем, сообщение останется в outbox до рестарта
+                retrying = True
+                raise
             except Exception as e:
                 logger.error(f"Ошибка в воркере {worker_id}: {e}")
-                await asyncio.sleep(1)
+            finally:
+                # Сообщение, ждущее повтора, ещё в работе: outbox и on_done - после последней попытки
+                if not retrying:
+                    if message.outbox_id is not None:
+                        self._outbox_acks.append(message.outbox_id)
+                    if message.on_done is not None:
+                        try:
+                            message.on_done(result)
+                        except Exception as e:
+                            logger.error(f"Ошибка в обработчике доставки: {e}")
+                self.queue.task_done()
+    
+    async def _deliver(self, chat_id: int, text: str, parse_mode: str,
+                       photo: Optional[str]) -> Tuple[str, Optional[str], Optional[Exception]]:
+        """Одна попытка отправки: (результат SEND_*, статус пользователя для недоступного чата, ошибка)"""
+        waited = await self.rate_limiter.acquire(chat_id)
+        metrics.observe('bot_rate_limiter_wait_seconds', waited)
+        try:
+            if photo:
+                await self._send_fast(chat_id, photo, text, parse_mode)
+            else:
+                await self._send_message_fast(chat_id, text, parse_mode)
+            return SEND_OK, None, None
+        except RetryAfter as e:
+            # Telegram просит подождать всех: ставим общую паузу, сам повтор - через политику
+            self.rate_limiter.pause(e.retry_after)
+            logger.warning(f"⏳ RetryAfter {e.retry_after} сек (чат {chat_id})")
+            return SEND_RETRY_AFTER, None, e
+        except Exception as e:
+            outcome, status = classify_send_error(e)
+            if outcome != SEND_DEAD:
+                logger.warning(f"⚠️ Не отправлено в чат {chat_id} ({outcome}): {e}")
+            return outcome, status, e
+    
+    async def _send_message_fast(self, chat_id: int, text: str, parse_mode: str):
+        started = time.perf_counter()
+        try:
+            await self.application.bot.send_message(
+                chat_id=chat_id,
+                text=text,
+                parse_mode=parse_mode,
+                disable_web_page_preview=True
+            )
+        finally:
+            metrics.observe('bot_send_seconds', time.perf_counter() - started, method='sendMessage')
+    
+    async def _send_fast(self, chat_id: int, photo: str, caption: str, parse_mode: str):
+        started = time.perf_counter()
+        try:
+            await self.application.bot.send_photo(
+                chat_id=chat_id,
+                photo=photo,
+                caption=caption,
+                parse_mode=parse_mode
+            )
+        finally:
+            metrics.observe('bot_send_seconds', time.perf_counter() - started, method='sendPhoto')
+
+# ========== РАССЫЛКИ ==========
+
+CAMPAIGN_CHUNK_SIZE = 500                # сколько получателей читаем из БД за раз
+CAMPAIGN_MAX_IN_FLIGHT = int(os.getenv("CAMPAIGN_MAX_IN_FLIGHT", "1000"))  # сообщений рассылки в очереди
+CAMPAIGN_PROGRESS_INTERVAL = 3.0         # как часто обновлять сообщение с прогрессом
+
+SQL_DELIVERY_QUEUED = "UPDATE mailing_deliveries SET status = 'queued', updated_at = ? WHERE campaign_id = ? AND user_id = ?"
+SQL_DELIVERY_RESULT = "UPDATE mailing_deliveries SET status = ?, updated_at = ? WHERE campaign_id = ? AND user_id = ?"
+SQL_CAMPAIGN_UPDATE = "UPDATE mailing_history SET status = ?, success_count = ?, failed_count = ?, updated_at = ? WHERE id = ?"
+
+CAMPAIGN_STATUS_NAMES = {
+    'running': '🚀 Идёт отправка',
+    'paused': '⏸ На паузе',
+    'cancelled': '⛔ Отменена',
+    'done': '✅ Завершена'
+}
+
+@dataclass
+class MailingCampaign:
+    id: int
+    admin_id: int
+    text: str
+    total: int
+    status: str = 'running'
+    success: int = 0
+    failed: int = 0
+    progress_chat_id: Optional[int] = None
+    progress_message_id: Optional[int] = None
+    in_flight: int = 0
+    dirty: bool = True
+    
+    @property
+    def remaining(self) -> int:
+        return max(0, self.total - self.success - self.failed)
+    
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'cancelled') and self.in_flight == 0
+
+class CampaignManager:
+    """Рассылки админа: отправка через MessageQueue, состояние доставок в БД, прогресс и пауза/отмена"""
+    
+    def __init__(self, telegram_bot_instance):
+        self.bot = telegram_bot_instance
+        self.campaigns: Dict[int, MailingCampaign] = {}
+        self._runners: Dict[int, asyncio.Task] = {}
+        self._results: List[tuple] = []
+        self._progress_task: Optional[asyncio.Task] = None
+    
+    async def start_campaign(self, admin_id: int, text: str, progress_chat_id: int,
+                             progress_message_id: int) -> Optional[MailingCampaign]:
+        # Недоступные чаты в рассылку не берём
+        users = await storage.read(get_active_users)
+        try:
+            campaign_id = await storage.transaction(
+                create_campaign, admin_id, text, users, progress_chat_id, progress_message_id
+            )
+        except Exception as e:
+            logger.error(f"❌ Ошибка создания рассылки: {e}")
+            return None
+        
+        campaign = MailingCampaign(campaign_id, admin_id, text, len(users),
+                                   progress_chat_id=progress_chat_id, progress_message_id=progress_message_id)
+        self.campaigns[campaign_id] = campaign
+        self._launch(campaign)
+        logger.info(f"📧 Рассылка #{campaign_id} запущена: {len(users)} получателей")
+        return campaign
+    
+    async def resume_unfinished(self):
+        """Подхватывает рассылки, прерванные рестартом"""
+        try:
+            await storage.write(SQL_REQUEUE_UNFINISHED_DELIVERIES)
+        except Exception as e:
+            logger.error(f"❌ Не удалось вернуть в очередь доставки прерванных рассылок: {e}")
+        for row in await storage.read(load_unfinished_campaigns):
+            campaign = MailingCampaign(**row)
+            self.campaigns[campaign.id] = campaign
+            if campaign.status == 'running':
+                self._launch(campaign)
+            logger.warning(f"📧 Рассылка #{campaign.id} восстановлена ({campaign.status}), осталось {campaign.remaining}")
+        if self.campaigns:
+            self._ensure_progress_loop()
+    
+    async def pause(self, campaign_id: int) -> bool:
+        campaign = self.campaigns.get(campaign_id)
+        if not campaign or campaign.status != 'running':
+            return False
+        campaign.status = 'paused'
+        campaign.dirty = True
+        await self._save(campaign)
+        return True
+    
+    async def resume(self, campaign_id: int) -> bool:
+        campaign = self.campaigns.get(campaign_id)
+        if not campaign or campaign.status != 'paused':
+            return False
+        # Старый раннер видит паузу и выходит сам; новый начинает с начала списка,
+        # чтобы подобрать получателей, вернувшихся в pending позади курсора
+        runner = self._runners.get(campaign_id)
+        if runner is not None and not runner.done():
+            await runner
+        if campaign.status != 'paused':
+            return False
+        campaign.status = 'running'
+        campaign.dirty = True
+        await self._save(campaign)
+        self._launch(campaign)
+        return True
+    
+    async def cancel(self, campaign_id: int) -> bool:
+        campaign = self.campaigns.get(campaign_id)
+        if not campaign or campaign.status not in ('running', 'paused'):
+            return False
+        campaign.status = 'cancelled'
+        campaign.dirty = True
+        await self._save(campaign)
+        return True
+    
+    async def stop(self):
+        """Останавливает раннеры при выключении; статус в БД не меняется, рассылка продолжится после рестарта"""
+        tasks = list(self._runners.values())
+        if self._progress_task is not None:
+            tasks.append(self._progress_task)
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._runners.clear()
+        self._progress_task = None
+        for campaign in self.campaigns.values():
+            await self._save(campaign)
+    
+    def _launch(self, campaign: MailingCampaign):
+        runner = self._runners.get(campaign.id)
+        if runner is None or runner.done():
+            self._runners[campaign.id] = asyncio.create_task(self._run(campaign))
+        self._ensure_progress_loop()
+    
+    def _ensure_progress_loop(self):
+        if self._progress_task is None or self._progress_task.done():
+            self._progress_task = asyncio.create_task(self._progress_loop())
+    
+    async def _run(self, campaign: MailingCampaign):
+        text = f"<b>📢 РАССЫЛКА</b>\n\n{campaign.text}"
+        is_cancelled = lambda: campaign.status != 'running'
+        last_user_id = 0
+        
+        try:
+            while campaign.status == 'running':
+                # Не забиваем очередь: личные уведомления о стоке должны идти вперемешку с рассылкой
+                if campaign.in_flight >= CAMPAIGN_MAX_IN_FLIGHT:
+                    await asyncio.sleep(0.2)
+                    continue
+                
+                limit = min(CAMPAIGN_CHUNK_SIZE, CAMPAIGN_MAX_IN_FLIGHT - campaign.in_flight)
+                batch = await storage.read(get_pending_deliveries, campaign.id, last_user_id, limit)
+                if not batch:
+                    if campaign.in_flight == 0:
+                        if last_user_id:
+                            # Перед завершением проверяем весь список: пропущенные на паузе снова pending
+                            await self._flush_results()
+                            last_user_id = 0
+                            continue
+                        campaign.status = 'done'
+                        campaign.dirty = True
+                        break
+                    await asyncio.sleep(0.2)
+                    continue
+                
+                now = datetime.now().isoformat()
+                await storage.write_many(SQL_DELIVERY_QUEUED, [(now, campaign.id, uid) for uid in batch])
+                for uid in batch:
+                    campaign.in_flight += 1
+                    await self.bot.message_queue.put(
+                        uid, text,
+                        on_done=lambda result, uid=uid: self._on_delivery(campaign, uid, result),
+                        is_cancelled=is_cancelled,
+                        lane=LANE_MAILING
+                    )
+                last_user_id = batch[-1]
+        except Exception as e:
+            logger.error(f"❌ Ошибка рассылки #{campaign.id}: {e}")
+            if campaign.status == 'running':
+                campaign.status = 'paused'
+                campaign.dirty = True
+        finally:
+            await self._save(campaign)
+    
+    def _on_delivery(self, campaign: MailingCampaign, user_id: int, result: Optional[bool]):
+        campaign.in_flight -= 1
+        campaign.dirty = True
+        if result is None:
+            # Пропущено из-за паузы/отмены: на паузе получатель снова ждёт отправки
+            status = 'pending' if campaign.status == 'paused' else 'cancelled'
+        elif result:
+            status = 'sent'
+            campaign.success += 1
+        else:
+            status = 'failed'
+            campaign.failed += 1
+        self._results.append((status, datetime.now().isoformat(), campaign.id, user_id))
+    
+    async def _flush_results(self):
+        if self._results:
+            results, self._results = self._results, []
+            await storage.write_many(SQL_DELIVERY_RESULT, results)
+    
+    async def _save(self, campaign: MailingCampaign):
+        try:
+            await self._flush_results()
+            await storage.write(
+                SQL_CAMPAIGN_UPDATE,
+                (campaign.status, campaign.success, campaign.failed, datetime.now().isoformat(), campaign.id)
+            )
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения рассылки #{campaign.id}: {e}")
+    
+    async def _progress_loop(self):
+        while self.campaigns:
+            await asyncio.sleep(CAMPAIGN_PROGRESS_INTERVAL)
+            for campaign in list(self.campaigns.values()):
+                if not campaign.dirty:
+                    continue
+                campaign.dirty = False
+                await self._save(campaign)
+                await self._show_progress(campaign)
+                
+                if campaign.finished:
+                    del self.campaigns[campaign.id]
+                    self._runners.pop(campaign.id, None)
+                    logger.info(
+                        f"📧 Рассылка #{campaign.id} {campaign.status}: "
+                        f"✅ {campaign.success}, ❌ {campaign.failed} из {campaign.total}"
+                    )
+    
+    def progress_text(self, campaign: MailingCampaign) -> str:
+        done = campaign.success + campaign.failed
+        percent = done / campaign.total * 100 if campaign.total else 100
+        title = "📊 ОТЧЕТ О РАССЫЛКЕ" if campaign.finished else "📧 РАССЫЛКА"
+        return (
+            f"<b>{title} #{campaign.id}</b>\n\n"
+            f"📌 <b>Статус:</b> {CAMPAIGN_STATUS_NAMES.get(campaign.status, campaign.status)}\n"
+            f"✅ <b>Успешно доставлено:</b> {campaign.success}\n"
+            f"❌ <b>Ошибок отправки:</b> {campaign.failed}\n"
+            f"⏳ <b>Осталось:</b> {campaign.remaining}\n"
+            f"👥 <b>Всего пользователей:</b> {campaign.total}\n"
+            f"📈 <b>Прогресс:</b> {percent:.1f}%"
+        )
+    
+    def progress_keyboard(self, campaign: MailingCampaign) -> Optional[InlineKeyboardMarkup]:
+        if campaign.status == 'running':
+            toggle = InlineKeyboardButton("⏸ ПАУЗА", callback_data=f"campaign_pause_{campaign.id}")
+        elif campaign.status == 'paused':
+            toggle = InlineKeyboardButton("▶️ ПРОДОЛЖИТЬ", callback_data=f"campaign_resume_{campaign.id}")
+        else:
+            return None
+        return InlineKeyboardMarkup([[toggle, InlineKeyboardButton("⛔ ОТМЕНИТЬ", callback_data=f"campaign_cancel_{campaign.id}")]])
+    
+    async def _show_progress(self, campaign: MailingCampaign):
+        if not campaign.progress_chat_id or not campaign.progress_message_id:
+            return
+        try:
+            await self.bot.application.bot.edit_message_text(
+                chat_id=campaign.progress_chat_id,
+                message_id=campaign.progress_message_id,
+                text=self.progress_text(campaign),
+                parse_mode='HTML',
+                reply_markup=self.progress_keyboard(campaign)
+            )
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logger.error(f"❌ Не удалось обновить прогресс рассылки #{campaign.id}: {e}")
+        except Exception as e:
+            logger.error(f"❌ Не удалось обновить прогресс рассылки #{campaign.id}: {e}")
+
+# ========== КЛИЕНТ API СТОКА ==========
+
+class StockApiClient:
+    """Асинхронный клиент API стока: keep-alive, условные запросы (ETag/Last-Modified) и жёсткий дедлайн"""
+    
+    def __init__(self, url: str = API_URL, timeout: float = STOCK_API_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
+        self._etag: Optional[str] = None
+        self._last_modified: Optional[str] = None
+        self._last_data: Optional[Dict] = None
+        
+        self.requests = 0
+        self.not_modified = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.latencies = deque(maxlen=500)
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_connections=4, max_keepalive_connections=2),
+                headers={
+                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+                    'Accept': 'application/json'
+                }
+            )
+        return self._client
+    
+    async def fetch(self) -> Optional[Dict]:
+        headers = {}
+        if self._last_data is not None:
+            if self._etag:
+                headers['If-None-Match'] = self._etag
+            if self._last_modified:
+                headers['If-Modified-Since'] = self._last_modified
+        
+        self.requests += 1
+        started = time.perf_counter()
+        try:
+            # wait_for - общий дедлайн на запрос целиком, а не на каждую фазу соединения
+            response = await asyncio.wait_for(self._get_client().get(self.url, headers=headers), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.error(f"❌ API не ответил за {self.timeout} сек")
+            return None
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"❌ Ошибка API: {e}")
+            return None
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+        
+        if response.status_code == 304:
+            self.not_modified += 1
+            return self._last_data
+        
+        if response.status_code != 200:
+            self.errors += 1
+            return None
+        
+        try:
+            data = json_loads(response.content)
+        except ValueError as e:
+            self.errors += 1
+            logger.error(f"❌ Ошибка разбора ответа API: {e}")
+            return None
+        
+        if not isinstance(data, dict) or not isinstance(data.get("data"), dict):
+            self.errors += 1
+            logger.error(f"❌ Неожиданный формат ответа API: {type(data).__name__}")
+            return None
+        
+        if data.get("ok"):
+            self._etag = response.headers.get('ETag')
+            self._last_modified = response.headers.get('Last-Modified')
+            self._last_data = data["data"]
+            return self._last_data
+        return None
+    
+    def latency_ms(self, percentile: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[index] * 1000
+    
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+class StockPoller:
+    """Снимок стока, который фоном обновляется раз в UPDATE_INTERVAL; обработчики читают снимок"""
     
-    async def _send_message_fast(self, chat_id: int, text: str, parse_mode: str):
-        try:
-            await self.application.bot.send_message(
-                chat_id=chat_id,
-                text=text,
-                parse_mode=parse_mode,
-                disable_web_page_preview=True
-            )
-        except:
-            pass
+    def __init__(self, client: StockApiClient, interval: float = UPDATE_INTERVAL,
+                 max_staleness: float = STOCK_MAX_STALENESS):
+        self.client = client
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self.data: Optional[Dict] = None
+        self.fetched_at = 0.0
+        self._inflight: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+        
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
     
-    async def _send_fast(self, chat_id: int, photo: str, caption: str, parse_mode: str):
-        try:
-            await self.application.bot.send_photo(
-                chat_id=chat_id,
-                photo=photo,
-                caption=caption,
-                parse_mode=parse_mode
-            )
-        except:
-            pass
+    def age(self) -> float:
+        if self.data is None:
+            return float('inf')
+        return time.monotonic() - self.fetched_at
+    
+    def is_fresh(self) -> bool:
+        return self.age() <= self.max_staleness
+    
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total * 100 if total else 0.0
+    
+    async def refresh(self) -> Optional[Dict]:
+        # Одновременные промахи ждут один и тот же запрос к API
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.create_task(self._fetch())
+        await asyncio.shield(self._inflight)
+        return self.data if self.is_fresh() else None
+    
+    async def _fetch(self):
+        self.fetches += 1
+        data = await self.client.fetch()
+        if data is not None:
+            self.data = data
+            self.fetched_at = time.monotonic()
+    
+    async def get(self) -> Optional[Dict]:
+        if self.is_fresh():
+            self.hits += 1
+            # stale-while-revalidate: отдаём снимок сразу, а устаревший обновляем в фоне
+            if self.age() > self.interval and (self._inflight is None or self._inflight.done()):
+                self._inflight = asyncio.create_task(self._fetch())
+            return self.data
+        
+        self.misses += 1
+        return await self.refresh()
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._poll_loop())
+    
+    async def stop(self):
+        for task in (self._task, self._inflight):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = None
+        await self.client.close()
+    
+    async def _poll_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"❌ Ошибка фонового обновления стока: {e}")
 
 # ========== DISCORD СЛУШАТЕЛЬ ==========
 
@@ -1048,17 +3000,17 @@ class DiscordListener:
     async def send_weather_to_users(self, weather_type: str, end_timestamp: int = None, update_id: str = None):
         """Отправляет уведомление о погоде всем пользователям"""
         weather_msg = self.format_weather_started_message(weather_type, end_timestamp)
-        users = get_all_users()
+        users = self.bot.user_manager.index.subscribers(weather_type)
         
         if users and update_id:
+            if await storage.read(was_weather_notification_sent, weather_type, 'started', update_id):
+                return
+            
             sent_count = 0
-            for user_id in users:
+            for user_id in list(users):
                 if user_id != ADMIN_ID:
-                    settings = self.bot.user_manager.get_user(user_id)
-                    if settings.notifications_enabled and settings.weather.get(weather_type, ItemSettings()).enabled:
-                        if not was_weather_notification_sent(weather_type, 'started', update_id):
-                            await self.bot.message_queue.queue.put((user_id, weather_msg, 'HTML', None))
-                            sent_count += 1
+                    await self.bot.message_queue.put(user_id, weather_msg)
+                    sent_count += 1
             
             if sent_count > 0:
                 logger.info(f"🌤 Отправлено уведомление о погоде {weather_type} {sent_count} пользователям")
@@ -1074,7 +3026,7 @@ class DiscordListener:
         
         # Множество для отслеживания отправленных в этом апдейте
         sent_in_update = set()
-        stats = {'main': 0, 'autopost': 0, 'weather': 0, 'users': 0}
+        stats = {'main': 0, 'autopost': 0, 'weather': 0, 'users': 0, 'groups': 0}
         weather_key = None
         
         # ===== 1. ОСНОВНОЙ КАНАЛ (только редкие) =====
@@ -1082,10 +3034,10 @@ class DiscordListener:
             for item_name, qty in rare_items:
                 key = f"{item_name}_{qty}"
                 if key not in sent_in_update:
-                    if not was_item_sent_in_this_update(item_name, qty, update_id):
+                    if not await storage.read(was_item_sent_in_this_update, item_name, qty, update_id):
                         msg = self.format_channel_message(item_name, qty)
-                        await self.bot.message_queue.queue.put((self.main_channel_id, msg, 'HTML', None))
-                        mark_item_sent_for_update(item_name, qty, update_id)
+                        await self.bot.message_queue.put(self.main_channel_id, msg)
+                        storage.mark_item_sent_for_update(item_name, qty, update_id)
                         sent_in_update.add(key)
                         stats['main'] += 1
                         logger.info(f"📤 Основной канал: {item_name} x{qty}")
@@ -1097,9 +3049,9 @@ class DiscordListener:
                     for item_name, qty in rare_items:
                         key = f"{item_name}_{qty}"
                         if key not in sent_in_update:
-                            if not was_item_sent_in_this_update(item_name, qty, update_id):
+                            if not await storage.read(was_item_sent_in_this_update, item_name, qty, update_id):
                                 msg = self.format_channel_message(item_name, qty)
-                                await self.bot.message_queue.queue.put((int(channel['id']), msg, 'HTML', None))
+                                await self.bot.message_queue.put(int(channel['id']), msg)
                                 sent_in_update.add(key)
                                 stats['autopost'] += 1
                                 logger.info(f"📤 Автопостинг {channel['name']}: {item_name} x{qty}")
@@ -1112,7 +3064,7 @@ class DiscordListener:
             if weather_key not in sent_in_update:
                 # Отправляем в автопостинг
                 for channel in self.bot.posting_channels:
-                    await self.bot.message_queue.queue.put((int(channel['id']), weather_info, 'HTML', None))
+                    await self.bot.message_queue.put(int(channel['id']), weather_info)
                     stats['weather'] += 1
                 
                 # Отправляем в личку
@@ -1131,60 +3083,48 @@ class DiscordListener:
         
         # ===== 4. ЛИЧКА (ВСЕ предметы с учетом настроек) =====
         if all_items:
-            users = get_all_users()
-            if users:
+            # Всё, что уже ушло в этом апдейте, одним запросом; дальше дельта считается в памяти
+            already_sent = await storage.read(get_sent_items_for_update, update_id)
+            # Получатели сгруппированы по набору предметов: у большинства настройки совпадают,
+            # поэтому сообщение собирается один раз на группу, а в очередь уходит общая строка
+            groups = self.bot.user_manager.recipient_groups(all_items, already_sent)
+            if groups:
+                pm_weather = weather_info if weather_info and weather_key and weather_key not in sent_in_update else None
+                new_marks = []
                 user_count = 0
-                for user_id in users:
-                    if user_id == ADMIN_ID:
-                        continue
-                    
-                    settings = self.bot.user_manager.get_user(user_id)
-                    if not settings.notifications_enabled:
+                debug_enabled = logger.isEnabledFor(logging.DEBUG)
+                for signature, recipients in groups.items():
+                    user_items = [all_items[position] for position in signature]
+                    pm_message = self.format_pm_message(user_items, pm_weather)
+                    if not pm_message:
                         continue
-                    
-                    # Собираем предметы для этого пользователя
-                    user_items = []
-                    
-                    for name, qty in all_items:
-                        key = f"{name}_{qty}"
-                        
-                        # Пропускаем если уже отправлено в этом апдейте
-                        if key in sent_in_update:
-                            continue
-                        
-                        # Проверяем настройки пользователя - ИСПРАВЛЕНО!
-                        enabled = False
-                        if name in SEEDS_LIST:
-                            seed_settings = settings.seeds.get(name)
-                            if seed_settings:
-                                enabled = seed_settings.enabled
-                        elif name in GEAR_LIST:
-                            gear_settings = settings.gear.get(name)
-                            if gear_settings:
-                                enabled = gear_settings.enabled
-                        elif name in WEATHER_LIST:
-                            weather_settings = settings.weather.get(name)
-                            if weather_settings:
-                                enabled = weather_settings.enabled
-                        
-                        if enabled and not was_item_sent_to_user(user_id, name, qty, update_id):
-                            user_items.append((name, qty))
-                            logger.info(f"✅ Добавлен {name} x{qty} для user {user_id}")
-                    
-                    if user_items:
-                        pm_message = self.format_pm_message(user_items, weather_info if weather_info and weather_key and weather_key not in sent_in_update else None)
-                        if pm_message:
-                            await self.bot.message_queue.queue.put((user_id, pm_message, 'HTML', None))
-                            for name, qty in user_items:
-                                mark_item_sent_to_user(user_id, name, qty, update_id)
-                                sent_in_update.add(f"{name}_{qty}")
-                            user_count += 1
-                            logger.info(f"📤 Отправлено пользователю {user_id}: {len(user_items)} предметов")
+                    for user_id in recipients:
+                        await self.bot.message_queue.put(user_id, pm_message)
+                        new_marks.extend((user_id, name, qty) for name, qty in user_items)
+                    user_count += len(recipients)
+                    # Построчный лог на каждого пользователя только в DEBUG: на больших апдейтах это сотни тысяч строк
+                    if debug_enabled:
+                        logger.debug("📤 Группа %s: %s пользователей", user_items, len(recipients))
+                stats['groups'] = len(groups)
+                
+                if new_marks:
+                    try:
+                        await storage.mark_items_sent_to_users(new_marks, update_id)
+                    except Exception as e:
+                        logger.error(f"❌ Не удалось сохранить отметки апдейта {update_id}: {e}")
                 
                 if user_count > 0:
                     stats['users'] = user_count
+                    logger.info(
+                        f"📤 Личка апдейта {update_id}: {user_count} пользователей, {len(new_marks)} предметов, "
+                        f"{len(groups)} разных сообщений",
+                        extra={'update_id': update_id, 'users': user_count, 'items': len(new_marks), 'groups': len(groups)}
+                    )
         
-        logger.info(f"✅ Апдейт {update_id} обработан: main={stats['main']}, autopost={stats['autopost']}, weather={stats['weather']}, users={stats['users']}")
+        logger.info(
+            f"✅ Апдейт {update_id} обработан: main={stats['main']}, autopost={stats['autopost']}, weather={stats['weather']}, users={stats['users']}, groups={stats['groups']}",
+            extra={'update_id': update_id, **stats}
+        )
     
     async def run(self):
         if not DISCORD_TOKEN or not DISCORD_GUILD_ID:
@@ -1271,15 +3211,13 @@ class DiscordListener:
                                                 logger.info(f"🌤 Сформирована погода: {weather_info}")
                                                 
                                                 # Отправляем уведомление о погоде отдельно
-                                                if not was_weather_notification_sent(name, 'started', str(msg_id)):
+                                                if not await storage.read(was_weather_notification_sent, name, 'started', str(msg_id)):
                                                     # Отправляем в каналы автопостинга
                                                     for channel in self.bot.posting_channels:
-                                                        await self.bot.message_queue.queue.put(
-                                                            (int(channel['id']), weather_info, 'HTML', None)
-                                                        )
+                                                        await self.bot.message_queue.put(int(channel['id']), weather_info)
                                                     # И в личку
                                                     await self.send_weather_to_users(name, end_timestamp, str(msg_id))
-                                                    mark_weather_notification_sent(name, 'started', str(msg_id))
+                                                    storage.mark_weather_notification_sent(name, 'started', str(msg_id))
                                     
                                     if all_items or rare_items or weather_info:
                                         await self.send_to_destinations(all_items, rare_items, weather_info)
@@ -1332,11 +3270,213 @@ class DiscordListener:
     def stop(self):
         self.running = False
 
+# ========== КЭШ ==========
+
+class TTLCache:
+    """Словарь с индивидуальным временем жизни записей и счётчиками попаданий"""
+    
+    def __init__(self):
+        self._data: Dict[Any, Tuple[Any, float]] = {}
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if time.monotonic() < expires_at:
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+    
+    def set(self, key, value, ttl: float):
+        self._data[key] = (value, time.monotonic() + ttl)
+    
+    def delete(self, key):
+        self._data.pop(key, None)
+    
+    def purge_expired(self) -> int:
+        now = time.monotonic()
+        expired = [key for key, (_, expires_at) in self._data.items() if expires_at <= now]
+        for key in expired:
+            del self._data[key]
+        return len(expired)
+    
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total * 100 if total else 0.0
+    
+    def __len__(self):
+        return len(self._data)
+
+@dataclass
+class StockView:
+    text: str
+    reply_markup: InlineKeyboardMarkup
+    expires_at: Optional[float] = None
+    # InputMediaPhoto для правки сообщения по источнику картинки (file_id или URL)
+    _media: Dict[str, InputMediaPhoto] = field(default_factory=dict, repr=False)
+    
+    def media(self, source: str) -> InputMediaPhoto:
+        media = self._media.get(source)
+        if media is None:
+            media = self._media[source] = InputMediaPhoto(media=source, caption=self.text, parse_mode='HTML')
+        return media
+
+class StockRenderCache:
+    """Готовые к отправке представления стока (текст и клавиатура) по версии данных"""
+    
+    def __init__(self, render: Callable[[Dict], Optional[str]], max_size: int = STOCK_RENDER_CACHE_SIZE):
+        self._render = render
+        self._views: OrderedDict = OrderedDict()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def data_key(data: Dict):
+        update = data.get('lastGlobalUpdate')
+        if update is not None:
+            return update
+        return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+    
+    @staticmethod
+    def expires_at(data: Dict) -> Optional[float]:
+        # Блок погоды исчезает по её endTimestamp, даже если сами данные не менялись
+        weather = data.get('weather')
+        if is_weather_active(weather) and weather.get('endTimestamp'):
+            return weather['endTimestamp']
+        return None
+    
+    def get(self, data: Dict) -> Optional[StockView]:
+        key = self.data_key(data)
+        view = self._views.get(key)
+        if view is not None and (view.expires_at is None or time.time() < view.expires_at):
+            self._views.move_to_end(key)
+            self.hits += 1
+            return view
+        
+        self.misses += 1
+        text = self._render(data)
+        if not text:
+            self._views.pop(key, None)
+            return None
+        
+        view = StockView(
+            text=text,
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 ГЛАВНОЕ МЕНЮ", callback_data="menu_main")]]),
+            expires_at=self.expires_at(data)
+        )
+        self._views[key] = view
+        self._views.move_to_end(key)
+        while len(self._views) > self.max_size:
+            self._views.popitem(last=False)
+        return view
+
+# BadRequest, после которых file_id бесполезен и картинку нужно заново загрузить по URL
+FILE_ID_ERROR_MARKERS = ("wrong file identifier", "wrong remote file", "file reference")
+
+class ImageRegistry:
+    """file_id картинок меню: каждая картинка загружается в Telegram по URL один раз, дальше - по file_id"""
+    
+    def __init__(self):
+        self.file_ids: Dict[str, str] = {}
+        self.uploads = 0
+        self.rejected = 0
+    
+    async def load(self):
+        self.file_ids = await storage.read(load_media_cache)
+        if self.file_ids:
+            logger.info(f"🖼 Загружено {len(self.file_ids)} file_id картинок")
+    
+    def media(self, url: str) -> str:
+        return self.file_ids.get(url, url)
+    
+    def remember(self, url: str, message) -> None:
+        if url in self.file_ids or not isinstance(message, Message) or not message.photo:
+            return
+        file_id = message.photo[-1].file_id
+        self.file_ids[url] = file_id
+        self.uploads += 1
+        storage.write(SQL_MEDIA_CACHE_SAVE, (url, file_id, datetime.now().isoformat()))
+        logger.info(f"🖼 Сохранён file_id для {url}")
+    
+    @staticmethod
+    def is_file_id_error(error: Exception) -> bool:
+        """Ошибка относится к самому file_id, а не к сообщению, подписи или клавиатуре"""
+        message = str(error).lower()
+        return any(marker in message for marker in FILE_ID_ERROR_MARKERS)
+    
+    def forget(self, url: str) -> bool:
+        if self.file_ids.pop(url, None) is None:
+            return False
+        self.rejected += 1
+        storage.write(SQL_MEDIA_CACHE_DELETE, (url,))
+        logger.warning(f"🖼 Telegram отклонил file_id для {url}, загружаю заново")
+        return True
+
+image_registry = ImageRegistry()
+
 # ========== MIDDLEWARE ==========
 
 class SubscriptionMiddleware:
     def __init__(self, bot_instance):
         self.bot = bot_instance
+        # Приглашение подписаться (подпись + кнопки) строится один раз на версию реестра каналов
+        self._prompt: Optional[Tuple[str, InlineKeyboardMarkup]] = None
+        self._prompt_version = -1
+        # Если ссылку на канал получить не удалось, приглашение живёт SUBSCRIPTION_PROMPT_RETRY
+        self._prompt_expires: Optional[float] = None
+        self._prompt_lock = asyncio.Lock()
+    
+    async def _channel_url(self, channel_id: str) -> Optional[str]:
+        if channel_id.startswith('@'):
+            return f"https://t.me/{channel_id.lstrip('@')}"
+        try:
+            chat = await self.bot.application.bot.get_chat(int(channel_id))
+            if chat.username:
+                return f"https://t.me/{chat.username}"
+            if chat.invite_link:
+                return chat.invite_link
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось получить ссылку на канал {channel_id}: {e}")
+        return None
+    
+    def _prompt_valid(self, version: int) -> bool:
+        if self._prompt is None or self._prompt_version != version:
+            return False
+        return self._prompt_expires is None or time.monotonic() < self._prompt_expires
+    
+    async def get_prompt(self) -> Tuple[str, InlineKeyboardMarkup]:
+        await channel_registry.refresh()
+        # Версию берём до чтения каналов: если реестр изменится посередине, просто пересоберём ещё раз
+        version = channel_registry.loaded_version
+        if self._prompt_valid(version):
+            return self._prompt
+        
+        async with self._prompt_lock:
+            if self._prompt_valid(version):
+                return self._prompt
+            
+            text = "📢 Для использования бота необходимо подписаться на каналы 👇\n\n"
+            buttons = []
+            complete = True
+            for channel in channel_registry.mandatory:
+                text += f"▪️ {channel['name']}\n"
+                url = await self._channel_url(channel['id'])
+                if url is None:
+                    # Без ссылки кнопку не показываем: название канала остаётся в тексте
+                    complete = False
+                    continue
+                buttons.append([InlineKeyboardButton(text=f"📢 {channel['name']}", url=url)])
+            buttons.append([InlineKeyboardButton(text="✅ Я подписался", callback_data="check_our_sub")])
+            
+            self._prompt = (f"<b>{text}</b>", InlineKeyboardMarkup(buttons))
+            self._prompt_version = version
+            self._prompt_expires = None if complete else time.monotonic() + SUBSCRIPTION_PROMPT_RETRY
+            return self._prompt
     
     async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
@@ -1353,7 +3493,7 @@ class SubscriptionMiddleware:
         if update.message and update.message.text and update.message.text.startswith('/start'):
             return True
         
-        channels = self.bot.reload_channels()
+        channels = self.bot.mandatory_channels
         
         if not channels:
             return True
@@ -1361,50 +3501,16 @@ class SubscriptionMiddleware:
         is_subscribed = await self.bot.check_our_subscriptions(user.id)
         
         if not is_subscribed:
-            text = "📢 Для использования бота необходимо подписаться на каналы 👇\n\n"
-            buttons = []
-            
-            for channel in channels:
-                text += f"▪️ {channel['name']}\n"
-                
-                channel_id = channel['id']
-                if channel_id.startswith('@'):
-                    url = f"https://t.me/{channel_id.lstrip('@')}"
-                else:
-                    try:
-                        chat = await self.bot.application.bot.get_chat(int(channel_id))
-                        if chat.username:
-                            url = f"https://t.me/{chat.username}"
-                        else:
-                            url = f"tg://resolve?domain={channel_id}"
-                    except:
-                        url = f"tg://resolve?domain={channel_id}"
-                
-                buttons.append([InlineKeyboardButton(text=f"📢 {channel['name']}", url=url)])
-            
-            buttons.append([InlineKeyboardButton(text="✅ Я подписался", callback_data="check_our_sub")])
+            caption, reply_markup = await self.get_prompt()
             
             try:
                 if update.message:
-                    await update.message.reply_photo(
-                        photo=IMAGE_MAIN,
-                        caption=f"<b>{text}</b>",
-                        parse_mode='HTML',
-                        reply_markup=InlineKeyboardMarkup(buttons)
-                    )
+                    await self.bot.reply_photo(update.message, IMAGE_MAIN, caption, reply_markup)
                 elif update.callback_query:
                     try:
-                        await update.callback_query.edit_message_media(
-                            media=InputMediaPhoto(media=IMAGE_MAIN, caption=f"<b>{text}</b>", parse_mode='HTML'),
-                            reply_markup=InlineKeyboardMarkup(buttons)
-                        )
+                        await self.bot.edit_photo(update.callback_query, IMAGE_MAIN, caption, reply_markup)
                     except:
-                        await update.callback_query.message.reply_photo(
-                            photo=IMAGE_MAIN,
-                            caption=f"<b>{text}</b>",
-                            parse_mode='HTML',
-                            reply_markup=InlineKeyboardMarkup(buttons)
-                        )
+                        await self.bot.reply_photo(update.callback_query.message, IMAGE_MAIN, caption, reply_markup)
             except Exception as e:
                 logger.error(f"❌ Middleware: ошибка отправки сообщения: {e}")
             
@@ -1415,31 +3521,33 @@ class SubscriptionMiddleware:
 class GardenHorizonsBot:
     def __init__(self, token: str):
         self.token = token
-        self.application = Application.builder().token(token).build()
+        builder = Application.builder().token(token)
+        if TELEGRAM_API_URL:
+            builder = builder.base_url(TELEGRAM_API_URL)
+        self.application = builder.build()
         self.user_manager = UserManager()
-        self.last_data: Optional[Dict] = None
-        self.mandatory_channels = get_mandatory_channels()
-        self.posting_channels = get_posting_channels()
         self.mailing_text = None
         
         # Оптимизации
-        self.subscription_cache = {}
-        self.blacklist = set()
-        self.cache_ttl = SUBSCRIPTION_CACHE_TTL
+        # Подписка: положительный результат живёт SUBSCRIPTION_CACHE_TTL, отрицательный - меньше,
+        # чтобы только что подписавшийся пользователь не ждал долго
+        self.subscription_cache = TTLCache()
+        self.chat_ids: Dict[str, Any] = {}
         self.request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
         
         self.message_queue = MessageQueue()
         self.message_queue.application = self.application
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Accept': 'application/json',
-            'Cache-Control': 'no-cache, no-store, must-revalidate',
-            'Pragma': 'no-cache',
-            'Expires': '0'
-        })
+        self.message_queue.on_dead_chat = self.user_manager.set_status
+        self.campaigns = CampaignManager(self)
+        self.retention = RetentionJob(storage)
+        self.stock_api = StockApiClient()
+        self.stock_poller = StockPoller(self.stock_api)
+        self.stock_views = StockRenderCache(self.format_stock_message)
+        self.register_metrics()
         
         self.discord_listener = DiscordListener(self)
+        self._background_tasks: List[asyncio.Task] = []
+        self._metrics_server = None
         
         self.setup_conversation_handlers()
         self.setup_handlers()
@@ -1451,7 +3559,58 @@ class GardenHorizonsBot:
         asyncio.create_task(self._cleanup_cache_loop())
         
         logger.info(f"🤖 Бот инициализирован. Админ ID: {ADMIN_ID}")
-        logger.info(f"⚙️ Оптимизации: воркеров=5, кэш={SUBSCRIPTION_CACHE_TTL}с, макс_запросов={MAX_CONCURRENT_REQUESTS}")
+        logger.info(f"⚙️ Оптимизации: воркеров={MESSAGE_WORKERS}, кэш={SUBSCRIPTION_CACHE_TTL}/{SUBSCRIPTION_NEGATIVE_TTL}с, макс_запросов={MAX_CONCURRENT_REQUESTS}")
+    
+    def register_metrics(self):
+        metrics.gauge('bot_queue_depth', self.message_queue.depth,
+                      'Сообщений в очереди (включая ещё не записанные в outbox и ждущие повтора)')
+        for lane in LANE_WEIGHTS:
+            metrics.gauge('bot_queue_lane_depth', lambda lane=lane: self.message_queue.queue.lane_size(lane),
+                          'Сообщений в полосе очереди', lane=lane)
+        metrics.gauge('bot_rate_limiter_wait_seconds_total', lambda: self.message_queue.rate_limiter.total_wait,
+                      'Суммарное ожидание в ограничителе запросов', kind='counter')
+        metrics.gauge('bot_subscription_cache_hits_total', lambda: self.subscription_cache.hits,
+                      'Попадания в кэш подписок', kind='counter')
+        metrics.gauge('bot_subscription_cache_misses_total', lambda: self.subscription_cache.misses,
+                      'Промахи кэша подписок', kind='counter')
+        metrics.gauge('bot_subscription_cache_hit_ratio', lambda: self.subscription_cache.hit_rate() / 100,
+                      'Доля попаданий в кэш подписок')
+        metrics.gauge('bot_stock_snapshot_age_seconds', lambda: self.stock_poller.age(), 'Возраст снимка стока')
+        metrics.gauge('bot_event_loop_lag_max_seconds', lambda: metrics.loop_lag_max, 'Максимальная задержка event loop')
+        metrics.gauge('bot_users', lambda: len(self.user_manager.users), 'Пользователей в памяти')
+        metrics.gauge('bot_users_dead', lambda: sum(
+            count for status, count in self.user_manager.status_counts().items() if status != USER_ACTIVE
+        ), 'Пользователей с недоступным чатом')
+        metrics.gauge('bot_retention_rows_deleted_total', lambda: self.retention.total_rows_deleted,
+                      'Удалено записей истории отправок', kind='counter')
+        metrics.gauge('bot_retention_bytes_reclaimed_total', lambda: self.retention.total_bytes_reclaimed,
+                      'Освобождено байт БД и WAL чисткой истории', kind='counter')
+    
+    def metrics_text(self) -> str:
+        """Короткая сводка метрик для админ-панели"""
+        sent_rate, failed_rate = metrics.message_rates()
+        lines = [
+            f"📬 <b>Очередь:</b> {self.message_queue.depth()} ("
+            + ", ".join(f"{lane} {self.message_queue.queue.lane_size(lane)}" for lane in LANE_WEIGHTS) + ")",
+            f"📨 <b>Отправка:</b> {sent_rate:.1f}/сек, ошибок {failed_rate:.1f}/сек",
+            f"🐢 <b>Лаг event loop:</b> {metrics.loop_lag * 1000:.0f} мс (макс {metrics.loop_lag_max * 1000:.0f} мс)"
+        ]
+        for labels, histogram in sorted(metrics.histograms('bot_send_seconds').items()):
+            method = dict(labels).get('method', '?')
+            lines.append(f"⏱ <b>{method}:</b> p50 ≤{histogram.quantile(0.5) * 1000:.0f} мс, p95 ≤{histogram.quantile(0.95) * 1000:.0f} мс")
+        for lane in LANE_WEIGHTS:
+            histogram = metrics.histogram('bot_queue_wait_seconds', lane=lane)
+            if histogram and histogram.count:
+                lines.append(f"🛣 <b>Полоса {lane}:</b> ожидание p50 ≤{histogram.quantile(0.5) * 1000:.0f} мс, "
+                             f"p95 ≤{histogram.quantile(0.95) * 1000:.0f} мс")
+        wait = metrics.histogram('bot_rate_limiter_wait_seconds')
+        if wait and wait.count:
+            lines.append(f"🚦 <b>Ожидание лимитера:</b> в среднем {wait.sum / wait.count * 1000:.0f} мс")
+        for op in ('read', 'commit'):
+            histogram = metrics.histogram('bot_db_seconds', op=op)
+            if histogram and histogram.count:
+                lines.append(f"🗄 <b>БД {op}:</b> в среднем {histogram.sum / histogram.count * 1000:.1f} мс, p95 ≤{histogram.quantile(0.95) * 1000:.0f} мс")
+        return "\n".join(lines)
     
     async def process_update_with_middleware(self, update: Update):
         try:
@@ -1464,118 +3623,74 @@ class GardenHorizonsBot:
         except Exception as e:
             logger.error(f"⚡ Ошибка: {e}", exc_info=True)
     
-    def reload_channels(self):
-        self.mandatory_channels = get_mandatory_channels()
-        self.posting_channels = get_posting_channels()
-        return self.mandatory_channels
+    @property
+    def mandatory_channels(self) -> Tuple[Dict, ...]:
+        return channel_registry.mandatory
+    
+    @property
+    def posting_channels(self) -> Tuple[Dict, ...]:
+        return channel_registry.posting
     
     async def get_chat_id_safe(self, identifier):
+        # Числовой ID канала уже и есть chat_id - запрос к Telegram не нужен
+        if isinstance(identifier, int):
+            return identifier
+        if identifier.lstrip('-').isdigit():
+            return int(identifier)
+        
+        # @username резолвим один раз: chat_id канала не меняется
+        if identifier in self.chat_ids:
+            return self.chat_ids[identifier]
         try:
             chat = await self.application.bot.get_chat(identifier)
+            self.chat_ids[identifier] = chat.id
             return chat.id
         except Exception as e:
-            if isinstance(identifier, str) and identifier.lstrip('-').isdigit():
-                return int(identifier)
             return identifier
     
-    async def check_our_subscriptions(self, user_id: int) -> bool:
-        if user_id == ADMIN_ID:
-            return True
-        
-        if user_id in self.blacklist:
+    async def _is_channel_member(self, channel: Dict, user_id: int, statuses: Tuple[str, ...]) -> bool:
+        try:
+            chat_id = await self.get_chat_id_safe(channel['id'])
+            async with self.request_semaphore:
+                member = await self.application.bot.get_chat_member(chat_id, user_id)
+            return member.status in statuses
+        except Exception:
             return False
-        
-        current_time = time.time()
-        if user_id in self.subscription_cache:
-            is_subscribed, timestamp = self.subscription_cache[user_id]
-            if not is_subscribed:
-                return False
-            if current_time - timestamp < self.cache_ttl:
-                return True
-        
+    
+    async def _check_channels(self, user_id: int, statuses: Tuple[str, ...]) -> bool:
         channels = self.mandatory_channels
-        
         if not channels:
-            self.subscription_cache[user_id] = (True, current_time)
             return True
         
-        async with self.request_semaphore:
-            for channel in channels:
-                try:
-                    chat_id = await self.get_chat_id_safe(channel['id'])
-                    
-                    if chat_id is None:
-                        self.subscription_cache[user_id] = (False, current_time)
-                        self.blacklist.add(user_id)
-                        return False
-                    
-                    member = await self.application.bot.get_chat_member(chat_id, user_id)
-                    status = member.status
-                    
-                    if status not in ["member", "administrator", "creator", "restricted"]:
-                        self.subscription_cache[user_id] = (False, current_time)
-                        self.blacklist.add(user_id)
-                        return False
-                        
-                except Exception as e:
-                    self.subscription_cache[user_id] = (False, current_time)
-                    self.blacklist.add(user_id)
-                    return False
-            
-            self.subscription_cache[user_id] = (True, current_time)
-            if user_id in self.blacklist:
-                self.blacklist.remove(user_id)
-            return True
-    
-    async def verify_subscription_now(self, user_id: int) -> bool:
-        channels = self.mandatory_channels
+        # Все каналы проверяются параллельно: задержка ~ одного запроса, а не суммы
+        results = await asyncio.gather(*(self._is_channel_member(channel, user_id, statuses) for channel in channels))
+        is_subscribed = all(results)
         
-        if not channels:
+        ttl = SUBSCRIPTION_CACHE_TTL if is_subscribed else SUBSCRIPTION_NEGATIVE_TTL
+        self.subscription_cache.set(user_id, is_subscribed, ttl)
+        return is_subscribed
+    
+    async def check_our_subscriptions(self, user_id: int) -> bool:
+        if user_id == ADMIN_ID:
             return True
         
-        async with self.request_semaphore:
-            for channel in channels:
-                try:
-                    chat_id = await self.get_chat_id_safe(channel['id'])
-                    member = await self.application.bot.get_chat_member(chat_id, user_id)
-                    
-                    if member.status not in ["member", "administrator", "creator"]:
-                        self.subscription_cache[user_id] = (False, time.time())
-                        self.blacklist.add(user_id)
-                        return False
-                        
-                except Exception:
-                    self.subscription_cache[user_id] = (False, time.time())
-                    self.blacklist.add(user_id)
-                    return False
-            
-            self.subscription_cache[user_id] = (True, time.time())
-            if user_id in self.blacklist:
-                self.blacklist.remove(user_id)
-            return True
+        cached = self.subscription_cache.get(user_id)
+        if cached is not None:
+            return cached
+        
+        return await self._check_channels(user_id, ("member", "administrator", "creator", "restricted"))
+    
+    async def verify_subscription_now(self, user_id: int) -> bool:
+        return await self._check_channels(user_id, ("member", "administrator", "creator"))
     
     async def _cleanup_cache_loop(self):
         while True:
             await asyncio.sleep(300)
             
             try:
-                current_time = time.time()
-                
-                to_delete = []
-                for user_id, (_, timestamp) in self.subscription_cache.items():
-                    if current_time - timestamp > self.cache_ttl * 2:
-                        to_delete.append(user_id)
-                
-                for user_id in to_delete:
-                    del self.subscription_cache[user_id]
-                
-                if int(current_time) % 3600 < 300:
-                    blacklist_size = len(self.blacklist)
-                    self.blacklist.clear()
-                    logger.info(f"🧹 Очищен черный список ({blacklist_size} записей)")
-                
-                if to_delete:
-                    logger.info(f"🧹 Очищено {len(to_delete)} записей из кэша подписок")
+                removed = self.subscription_cache.purge_expired()
+                if removed:
+                    logger.info(f"🧹 Очищено {removed} записей из кэша подписок")
                     
             except Exception as e:
                 logger.error(f"❌ Ошибка при очистке кэша: {e}")
@@ -1646,7 +3761,10 @@ class GardenHorizonsBot:
     
     async def cmd_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        self.user_manager.get_user(user.id, user.username or user.first_name)
+        settings = self.user_manager.get_user(user.id, user.username or user.first_name)
+        if not settings.is_active:
+            # Пользователь снова написал боту - значит, чат опять доступен
+            self.user_manager.set_status(user.id, USER_ACTIVE)
         await self.show_main_menu(update)
     
     async def cmd_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1658,30 +3776,27 @@ class GardenHorizonsBot:
         await self.show_main_settings(update, settings)
     
     async def cmd_stock(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.message.reply_html("<b>🔍 Получаю актуальные данные...</b>")
-        data = self.fetch_api_data(force=True)
+        if not self.stock_poller.is_fresh():
+            await update.message.reply_html("<b>🔍 Получаю актуальные данные...</b>")
+        data = await self.stock_poller.get()
         if not data:
             await update.message.reply_html("<b>❌ Ошибка получения данных</b>")
             return
         
-        message = self.format_stock_message(data)
-        if message:
-            keyboard = [[InlineKeyboardButton("🏠 ГЛАВНОЕ МЕНЮ", callback_data="menu_main")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_html(message, reply_markup=reply_markup)
+        view = self.stock_views.get(data)
+        if view:
+            await update.message.reply_html(view.text, reply_markup=view.reply_markup)
     
     async def cmd_notifications_on(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
         settings = self.user_manager.get_user(user.id)
-        settings.notifications_enabled = True
-        update_user_setting(user.id, 'notifications_enabled', True)
+        self.user_manager.update_setting(settings, 'notifications_enabled', True)
         await update.message.reply_html("<b>✅ Уведомления успешно включены!</b>")
     
     async def cmd_notifications_off(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
         settings = self.user_manager.get_user(user.id)
-        settings.notifications_enabled = False
-        update_user_setting(user.id, 'notifications_enabled', False)
+        self.user_manager.update_setting(settings, 'notifications_enabled', False)
         await update.message.reply_html("<b>❌ Уведомления успешно выключены</b>")
     
     async def cmd_admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1691,11 +3806,10 @@ class GardenHorizonsBot:
             await update.message.reply_text("❌ <b>У вас нет прав!</b>", parse_mode='HTML')
             return
         
-        self.reload_channels()
         await self.show_admin_panel(update)
     
     async def show_admin_panel(self, update: Update):
-        users_count = get_users_count()
+        users_count = await storage.read(get_users_count)
         
         text = (
             "👑 <b>АДМИН-ПАНЕЛЬ</b>\n\n"
@@ -1710,6 +3824,7 @@ class GardenHorizonsBot:
             [InlineKeyboardButton("📢 УПРАВЛЕНИЕ АВТОПОСТИНГОМ", callback_data="admin_post")],
             [InlineKeyboardButton("📧 РАССЫЛКА", callback_data="mailing")],
             [InlineKeyboardButton("📊 СТАТИСТИКА", callback_data="admin_stats")],
+            [InlineKeyboardButton("📮 НЕДОСТАВЛЕННЫЕ", callback_data="admin_dead_letters")],
             [InlineKeyboardButton("🏠 ГЛАВНОЕ МЕНЮ", callback_data="menu_main")]
         ]
         
@@ -1719,7 +3834,7 @@ class GardenHorizonsBot:
             await update.callback_query.message.reply_text(text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
     
     async def show_admin_panel_callback(self, query):
-        users_count = get_users_count()
+        users_count = await storage.read(get_users_count)
         
         text = (
             "👑 <b>АДМИН-ПАНЕЛЬ</b>\n\n"
@@ -1734,14 +3849,13 @@ class GardenHorizonsBot:
             [InlineKeyboardButton("📢 УПРАВЛЕНИЕ АВТОПОСТИНГОМ", callback_data="admin_post")],
             [InlineKeyboardButton("📧 РАССЫЛКА", callback_data="mailing")],
             [InlineKeyboardButton("📊 СТАТИСТИКА", callback_data="admin_stats")],
+            [InlineKeyboardButton("📮 НЕДОСТАВЛЕННЫЕ", callback_data="admin_dead_letters")],
             [InlineKeyboardButton("🏠 ГЛАВНОЕ МЕНЮ", callback_data="menu_main")]
         ]
         
         await query.message.reply_text(text=text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
     
     async def show_op_menu(self, query):
-        self.reload_channels()
-        
         text = (
             "🔐 <b>УПРАВЛЕНИЕ ОБЯЗАТЕЛЬНОЙ ПОДПИСКОЙ (ОП)</b>\n\n"
             "<b>Каналы, на которые нужно подписаться для доступа к боту</b>\n\n"
@@ -1801,9 +3915,7 @@ class GardenHorizonsBot:
             
             final_id = f"@{chat.username}" if chat.username else str(chat.id)
             
-            add_mandatory_channel(final_id, channel_name)
-            self.reload_channels()
-            
+            await channel_registry.write(SQL_ADD_MANDATORY_CHANNEL, (final_id, channel_name))
             await update.message.reply_text(
                 f"✅ <b>Канал {channel_name} добавлен в обязательную подписку!</b>",
                 parse_mode='HTML'
@@ -1816,8 +3928,6 @@ class GardenHorizonsBot:
         return ConversationHandler.END
     
     async def show_op_remove(self, query):
-        self.reload_channels()
-        
         if not self.mandatory_channels:
             await query.message.reply_text("📭 <b>Нет каналов для удаления</b>", parse_mode='HTML')
             return
@@ -1832,14 +3942,16 @@ class GardenHorizonsBot:
     
     async def delete_op_channel(self, query):
         channel_id = query.data.replace('op_del_', '')
-        remove_mandatory_channel(channel_id)
-        self.reload_channels()
+        try:
+            await channel_registry.write(SQL_REMOVE_MANDATORY_CHANNEL, (channel_id,))
+        except Exception as e:
+            logger.error(f"❌ Ошибка удаления канала ОП из БД: {e}")
+            await query.answer("❌ Не удалось удалить канал", show_alert=True)
+            return
         await query.answer("✅ Канал удален из ОП!")
         await self.show_op_remove(query)
     
     async def show_op_list(self, query):
-        self.reload_channels()
-        
         if not self.mandatory_channels:
             text = "📭 <b>Нет каналов в обязательной подписке</b>"
         else:
@@ -1851,8 +3963,6 @@ class GardenHorizonsBot:
         await query.message.reply_text(text=text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
     
     async def show_post_menu(self, query):
-        self.reload_channels()
-        
         text = (
             "📢 <b>УПРАВЛЕНИЕ АВТОПОСТИНГОМ</b>\n\n"
             "<b>Каналы, в которые бот будет отправлять уведомления</b>\n\n"
@@ -1910,9 +4020,9 @@ class GardenHorizonsBot:
                 await self.show_admin_panel(update)
                 return ConversationHandler.END
             
-            add_posting_channel(str(chat.id), channel_name, chat.username)
-            self.reload_channels()
-            
+            await channel_registry.write(
+                SQL_ADD_POSTING_CHANNEL, (str(chat.id), channel_name, chat.username, datetime.now().isoformat())
+            )
             await update.message.reply_text(
                 f"✅ <b>Канал {channel_name} добавлен для автопостинга!</b>",
                 parse_mode='HTML'
@@ -1925,8 +4035,6 @@ class GardenHorizonsBot:
         return ConversationHandler.END
     
     async def show_post_remove(self, query):
-        self.reload_channels()
-        
         if not self.posting_channels:
             await query.message.reply_text("📭 <b>Нет каналов для удаления</b>", parse_mode='HTML')
             await self.show_post_menu(query)
@@ -1942,14 +4050,16 @@ class GardenHorizonsBot:
     
     async def delete_post_channel(self, query):
         channel_id = query.data.replace('post_del_', '')
-        remove_posting_channel(channel_id)
-        self.reload_channels()
+        try:
+            await channel_registry.write(SQL_REMOVE_POSTING_CHANNEL, (channel_id,))
+        except Exception as e:
+            logger.error(f"❌ Ошибка удаления канала автопостинга из БД: {e}")
+            await query.answer("❌ Не удалось удалить канал", show_alert=True)
+            return
         await query.answer("✅ Канал удален из автопостинга!")
         await self.show_post_remove(query)
     
     async def show_post_list(self, query):
-        self.reload_channels()
-        
         if not self.posting_channels:
             text = "📭 <b>Нет каналов для автопостинга</b>"
         else:
@@ -2028,58 +4138,144 @@ class GardenHorizonsBot:
             parse_mode='HTML'
         )
         
-        success = 0
-        failed = 0
-        users = get_all_users()
+        # Отправка идёт в фоне через очередь; прогресс обновляется в status_msg
+        campaign = await self.campaigns.start_campaign(user_id, text, status_msg.chat_id, status_msg.message_id)
+        if not campaign:
+            await status_msg.edit_text("❌ <b>Не удалось создать рассылку</b>", parse_mode='HTML')
+        else:
+            await status_msg.edit_text(
+                self.campaigns.progress_text(campaign),
+                parse_mode='HTML',
+                reply_markup=self.campaigns.progress_keyboard(campaign)
+            )
         
-        for uid in users:
-            try:
-                await context.bot.send_message(
-                    chat_id=uid,
-                    text=f"<b>📢 РАССЫЛКА</b>\n\n{text}",
-                    parse_mode='HTML'
-                )
-                success += 1
-                await asyncio.sleep(0.01)
-            except:
-                failed += 1
+        if 'mailing_text' in context.user_data:
+            del context.user_data['mailing_text']
         
+        await self.show_admin_panel_callback(query)
+    
+    async def handle_campaign_action(self, query):
         try:
-            await status_msg.delete()
-        except:
-            pass
+            _, action, campaign_id = query.data.split("_", 2)
+            campaign_id = int(campaign_id)
+        except ValueError:
+            return
         
-        report = (
-            f"<b>📊 ОТЧЕТ О РАССЫЛКЕ</b>\n\n"
-            f"✅ <b>Успешно доставлено:</b> {success}\n"
-            f"❌ <b>Ошибок отправки:</b> {failed}\n"
-            f"👥 <b>Всего пользователей:</b> {len(users)}"
-        )
+        actions = {
+            'pause': self.campaigns.pause,
+            'resume': self.campaigns.resume,
+            'cancel': self.campaigns.cancel
+        }
+        if action not in actions:
+            return
         
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=report,
-            parse_mode='HTML'
-        )
+        await actions[action](campaign_id)
         
-        if 'mailing_text' in context.user_data:
-            del context.user_data['mailing_text']
+        campaign = self.campaigns.campaigns.get(campaign_id)
+        if not campaign:
+            # Рассылка уже завершилась: итоговый отчёт в этом сообщении
+            try:
+                await query.message.edit_reply_markup(reply_markup=None)
+            except BadRequest:
+                pass
+            return
         
-        await self.show_admin_panel_callback(query)
+        try:
+            await query.message.edit_text(
+                self.campaigns.progress_text(campaign),
+                parse_mode='HTML',
+                reply_markup=self.campaigns.progress_keyboard(campaign)
+            )
+        except BadRequest:
+            pass
     
     async def show_stats(self, query):
-        users_count = get_users_count()
+        users_count = await storage.read(get_users_count)
+        status_counts = await storage.read(get_user_status_counts)
+        dead = {status: count for status, count in status_counts.items() if status != USER_ACTIVE}
+        dead_details = ", ".join(f"{USER_STATUS_NAMES.get(status, status)} {count}" for status, count in sorted(dead.items()))
         
         text = (
             "<b>📊 СТАТИСТИКА БОТА</b>\n\n"
             f"👥 <b>Всего пользователей:</b> {users_count}\n"
+            f"✅ <b>Активных:</b> {status_counts.get(USER_ACTIVE, 0)}, "
+            f"🚫 <b>недоступных:</b> {sum(dead.values())}" + (f" ({dead_details})" if dead_details else "") + "\n"
             f"🔐 <b>Каналов ОП:</b> {len(self.mandatory_channels)}\n"
-            f"📢 <b>Каналов для автопостинга:</b> {len(self.posting_channels)}"
+            f"📢 <b>Каналов для автопостинга:</b> {len(self.posting_channels)}\n"
+            f"🗄 <b>Открыто соединений с БД:</b> {db_pool.connections_opened}\n"
+            f"🎯 <b>Кэш подписок:</b> {self.subscription_cache.hits} попаданий / "
+            f"{self.subscription_cache.misses} промахов ({self.subscription_cache.hit_rate():.0f}%)\n"
+            f"📡 <b>API стока:</b> {self.stock_api.requests} запросов, {self.stock_api.not_modified} без изменений (304), "
+            f"p50 {self.stock_api.latency_ms(50):.0f} мс, p95 {self.stock_api.latency_ms(95):.0f} мс\n"
+            f"🗂 <b>Снимок стока:</b> возраст {self.stock_poller.age():.0f} сек, "
+            f"из снимка {self.stock_poller.hit_rate():.0f}% ({self.stock_poller.hits}/{self.stock_poller.misses})\n"
+            f"🧹 <b>История отправок:</b> {self.retention.summary()}\n\n"
+            f"<b>📈 МЕТРИКИ</b>\n{self.metrics_text()}"
+        )
+        
+        keyboard = [[InlineKeyboardButton("🔙 НАЗАД", callback_data="admin_panel")]]
+        await query.message.reply_text(text=text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+    
+    async def show_dead_letters(self, query):
+        counts = await storage.read(get_dead_letter_counts)
+        total = sum(counts.values())
+        
+        text = f"<b>📮 НЕДОСТАВЛЕННЫЕ СООБЩЕНИЯ</b>\n\n<b>Всего:</b> {total}\n"
+        for cause, count in sorted(counts.items(), key=lambda item: -item[1]):
+            text += f"• {cause}: {count}\n"
+        text += (
+            f"\n🔁 <b>Повторов в ожидании:</b> {self.message_queue.retry_pending()}, "
+            f"всего повторов {self.message_queue.retried}"
         )
         
+        keyboard = []
+        if total:
+            keyboard.append([InlineKeyboardButton("🔁 ОТПРАВИТЬ ПОВТОРНО", callback_data="dead_letters_replay")])
+        keyboard.append([InlineKeyboardButton("🔙 НАЗАД", callback_data="admin_panel")])
+        await query.message.reply_text(text=text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+    
+    async def replay_dead_letters(self, query):
+        def is_dead(chat_id: int) -> bool:
+            settings = self.user_manager.users.get(chat_id)
+            return settings is not None and not settings.is_active
+        
+        replayed, skipped = await self.message_queue.replay_dead_letters(skip=is_dead)
+        text = f"<b>🔁 В очередь возвращено:</b> {replayed}"
+        if skipped:
+            text += f"\n🚫 <b>Пропущено недоступных чатов:</b> {skipped}"
         keyboard = [[InlineKeyboardButton("🔙 НАЗАД", callback_data="admin_panel")]]
         await query.message.reply_text(text=text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
     
+    async def reply_photo(self, message, image: str, caption: str, reply_markup=None):
+        try:
+            sent = await message.reply_photo(
+                photo=image_registry.media(image), caption=caption, parse_mode='HTML', reply_markup=reply_markup
+            )
+        except BadRequest as e:
+            # Протухший file_id: забываем и отправляем по URL, новый file_id сохранится ниже
+            if not image_registry.is_file_id_error(e) or not image_registry.forget(image):
+                raise
+            sent = await message.reply_photo(photo=image, caption=caption, parse_mode='HTML', reply_markup=reply_markup)
+        image_registry.remember(image, sent)
+        return sent
+    
+    async def edit_photo(self, query, image: str, caption: str, reply_markup=None, view: Optional[StockView] = None):
+        def media(source):
+            # Представление стока держит готовый объект, чтобы не собирать его на каждое нажатие
+            if view is not None:
+                return view.media(source)
+            return InputMediaPhoto(media=source, caption=caption, parse_mode='HTML')
+        
+        try:
+            edited = await query.edit_message_media(media=media(image_registry.media(image)), reply_markup=reply_markup)
+        except BadRequest as e:
+            # Остальные ошибки (нет медиа в сообщении, нельзя редактировать, подпись) file_id не касаются
+            if not image_registry.is_file_id_error(e) or not image_registry.forget(image):
+                raise
+            edited = await query.edit_message_media(media=media(image), reply_markup=reply_markup)
+        image_registry.remember(image, edited)
+        return edited
+    
     async def show_main_menu(self, update: Update):
         user = update.effective_user
         settings = self.user_manager.get_user(user.id)
@@ -2100,7 +4296,7 @@ class GardenHorizonsBot:
         
         if update.message:
             await update.message.reply_text("🔄 <b>Обновляю меню...</b>", reply_markup=reply_markup_remove, parse_mode='HTML')
-            await update.message.reply_photo(photo=IMAGE_MAIN, caption=text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+            await self.reply_photo(update.message, IMAGE_MAIN, text, InlineKeyboardMarkup(keyboard))
         elif update.callback_query:
             await self.show_main_menu_callback(update.callback_query)
     
@@ -2121,12 +4317,9 @@ class GardenHorizonsBot:
             keyboard.append([InlineKeyboardButton("👑 АДМИН-ПАНЕЛЬ", callback_data="admin_panel")])
         
         try:
-            await query.edit_message_media(
-                media=InputMediaPhoto(media=IMAGE_MAIN, caption=text, parse_mode='HTML'),
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+            await self.edit_photo(query, IMAGE_MAIN, text, InlineKeyboardMarkup(keyboard))
         except:
-            await query.message.reply_photo(photo=IMAGE_MAIN, caption=text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+            await self.reply_photo(query.message, IMAGE_MAIN, text, InlineKeyboardMarkup(keyboard))
     
     async def show_main_settings(self, update: Update, settings: UserSettings):
         status = "🔔 ВКЛ" if settings.notifications_enabled else "🔕 ВЫКЛ"
@@ -2139,7 +4332,7 @@ class GardenHorizonsBot:
         ]
         
         if update.message:
-            await update.message.reply_photo(photo=IMAGE_MAIN, caption=text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+            await self.reply_photo(update.message, IMAGE_MAIN, text, InlineKeyboardMarkup(keyboard))
         elif update.callback_query:
             await self.show_main_settings_callback(update.callback_query, settings)
     
@@ -2154,18 +4347,15 @@ class GardenHorizonsBot:
         ]
         
         try:
-            await query.edit_message_media(
-                media=InputMediaPhoto(media=IMAGE_MAIN, caption=text, parse_mode='HTML'),
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+            await self.edit_photo(query, IMAGE_MAIN, text, InlineKeyboardMarkup(keyboard))
         except:
-            await query.message.reply_photo(photo=IMAGE_MAIN, caption=text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+            await self.reply_photo(query.message, IMAGE_MAIN, text, InlineKeyboardMarkup(keyboard))
     
     async def show_seeds_settings(self, query, settings: UserSettings):
         text = "<b>🌱 НАСТРОЙКИ СЕМЯН</b>\n\nНажмите на семя:"
         keyboard, row = [], []
         for seed_name in SEEDS_LIST:
-            enabled = settings.seeds.get(seed_name, ItemSettings()).enabled
+            enabled = settings.is_item_enabled(seed_name)
             status = "✅" if enabled else "❌"
             button_text = f"{status} {translate(seed_name)}"
             row.append(InlineKeyboardButton(button_text, callback_data=f"seed_toggle_{seed_name}"))
@@ -2177,18 +4367,15 @@ class GardenHorizonsBot:
         keyboard.append([InlineKeyboardButton("🏠 ГЛАВНОЕ МЕНЮ", callback_data="menu_main")])
         
         try:
-            await query.edit_message_media(
-                media=InputMediaPhoto(media=IMAGE_SEEDS, caption=text, parse_mode='HTML'),
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+            await self.edit_photo(query, IMAGE_SEEDS, text, InlineKeyboardMarkup(keyboard))
         except:
-            await query.message.reply_photo(photo=IMAGE_SEEDS, caption=text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+            await self.reply_photo(query.message, IMAGE_SEEDS, text, InlineKeyboardMarkup(keyboard))
     
     async def show_gear_settings(self, query, settings: UserSettings):
         text = "<b>⚙️ НАСТРОЙКИ СНАРЯЖЕНИЯ</b>\n\nНажмите на предмет:"
         keyboard, row = [], []
         for gear_name in GEAR_LIST:
-            enabled = settings.gear.get(gear_name, ItemSettings()).enabled
+            enabled = settings.is_item_enabled(gear_name)
             status = "✅" if enabled else "❌"
             button_text = f"{status} {translate(gear_name)}"
             row.append(InlineKeyboardButton(button_text, callback_data=f"gear_toggle_{gear_name}"))
@@ -2200,18 +4387,15 @@ class GardenHorizonsBot:
         keyboard.append([InlineKeyboardButton("🏠 ГЛАВНОЕ МЕНЮ", callback_data="menu_main")])
         
         try:
-            await query.edit_message_media(
-                media=InputMediaPhoto(media=IMAGE_GEAR, caption=text, parse_mode='HTML'),
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+            await self.edit_photo(query, IMAGE_GEAR, text, InlineKeyboardMarkup(keyboard))
         except:
-            await query.message.reply_photo(photo=IMAGE_GEAR, caption=text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+            await self.reply_photo(query.message, IMAGE_GEAR, text, InlineKeyboardMarkup(keyboard))
     
     async def show_weather_settings(self, query, settings: UserSettings):
         text = "<b>🌤️ НАСТРОЙКИ ПОГОДЫ</b>\n\nНажмите на погоду:"
         keyboard, row = [], []
         for weather_name in WEATHER_LIST:
-            enabled = settings.weather.get(weather_name, ItemSettings()).enabled
+            enabled = settings.is_item_enabled(weather_name)
             status = "✅" if enabled else "❌"
             button_text = f"{status} {translate(weather_name)}"
             row.append(InlineKeyboardButton(button_text, callback_data=f"weather_toggle_{weather_name}"))
@@ -2223,61 +4407,49 @@ class GardenHorizonsBot:
         keyboard.append([InlineKeyboardButton("🏠 ГЛАВНОЕ МЕНЮ", callback_data="menu_main")])
         
         try:
-            await query.edit_message_media(
-                media=InputMediaPhoto(media=IMAGE_WEATHER, caption=text, parse_mode='HTML'),
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+            await self.edit_photo(query, IMAGE_WEATHER, text, InlineKeyboardMarkup(keyboard))
         except:
-            await query.message.reply_photo(photo=IMAGE_WEATHER, caption=text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+            await self.reply_photo(query.message, IMAGE_WEATHER, text, InlineKeyboardMarkup(keyboard))
     
     async def show_stock_callback(self, query):
-        try:
-            await query.edit_message_media(
-                media=InputMediaPhoto(media=IMAGE_MAIN, caption="<b>🔍 Получаю данные...</b>", parse_mode='HTML')
-            )
-        except:
-            pass
+        # Заглушку показываем, только если снимка нет и придётся ждать API
+        if not self.stock_poller.is_fresh():
+            try:
+                await self.edit_photo(query, IMAGE_MAIN, "<b>🔍 Получаю данные...</b>")
+            except:
+                pass
         
-        data = self.fetch_api_data(force=True)
+        data = await self.stock_poller.get()
         if not data:
-            await query.edit_message_media(
-                media=InputMediaPhoto(media=IMAGE_MAIN, caption="<b>❌ Ошибка получения данных</b>", parse_mode='HTML')
-            )
+            await self.edit_photo(query, IMAGE_MAIN, "<b>❌ Ошибка получения данных</b>")
             return
         
-        message = self.format_stock_message(data)
-        if message:
-            keyboard = [[InlineKeyboardButton("🏠 ГЛАВНОЕ МЕНЮ", callback_data="menu_main")]]
-            await query.edit_message_media(
-                media=InputMediaPhoto(media=IMAGE_MAIN, caption=message, parse_mode='HTML'),
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+        view = self.stock_views.get(data)
+        if view:
+            await self.edit_photo(query, IMAGE_MAIN, view.text, view.reply_markup, view=view)
     
     async def handle_seed_callback(self, query, settings: UserSettings):
         parts = query.data.split("_")
         if len(parts) >= 3:
             seed_name = "_".join(parts[2:])
-            enabled = not settings.seeds[seed_name].enabled
-            settings.seeds[seed_name].enabled = enabled
-            update_user_setting(settings.user_id, f"seed_{seed_name}", enabled)
+            enabled = not settings.is_item_enabled(seed_name)
+            self.user_manager.update_setting(settings, f"seed_{seed_name}", enabled)
             await self.show_seeds_settings(query, settings)
     
     async def handle_gear_callback(self, query, settings: UserSettings):
         parts = query.data.split("_")
         if len(parts) >= 3:
             gear_name = "_".join(parts[2:])
-            enabled = not settings.gear[gear_name].enabled
-            settings.gear[gear_name].enabled = enabled
-            update_user_setting(settings.user_id, f"gear_{gear_name}", enabled)
+            enabled = not settings.is_item_enabled(gear_name)
+            self.user_manager.update_setting(settings, f"gear_{gear_name}", enabled)
             await self.show_gear_settings(query, settings)
     
     async def handle_weather_callback(self, query, settings: UserSettings):
         parts = query.data.split("_")
         if len(parts) >= 3:
             weather_name = "_".join(parts[2:])
-            enabled = not settings.weather[weather_name].enabled
-            settings.weather[weather_name].enabled = enabled
-            update_user_setting(settings.user_id, f"weather_{weather_name}", enabled)
+            enabled = not settings.is_item_enabled(weather_name)
+            self.user_manager.update_setting(settings, f"weather_{weather_name}", enabled)
             await self.show_weather_settings(query, settings)
     
     async def handle_user_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2301,14 +4473,12 @@ class GardenHorizonsBot:
             return
         
         if query.data == "notifications_on":
-            settings.notifications_enabled = True
-            update_user_setting(user.id, 'notifications_enabled', True)
+            self.user_manager.update_setting(settings, 'notifications_enabled', True)
             await query.message.reply_html("<b>✅ Уведомления включены!</b>")
             return
         
         if query.data == "notifications_off":
-            settings.notifications_enabled = False
-            update_user_setting(user.id, 'notifications_enabled', False)
+            self.user_manager.update_setting(settings, 'notifications_enabled', False)
             await query.message.reply_html("<b>❌ Уведомления выключены</b>")
             return
         
@@ -2340,7 +4510,7 @@ class GardenHorizonsBot:
             is_subscribed = await self.verify_subscription_now(user.id)
             
             if is_subscribed:
-                add_user_to_db(user.id, user.username or user.first_name)
+                storage.add_user(user.id, user.username or user.first_name)
                 
                 try:
                     await query.message.delete()
@@ -2398,9 +4568,21 @@ class GardenHorizonsBot:
             await self.show_stats(query)
             return
         
+        if query.data == "admin_dead_letters":
+            await self.show_dead_letters(query)
+            return
+        
+        if query.data == "dead_letters_replay":
+            await self.replay_dead_letters(query)
+            return
+        
         if query.data in ["mailing_yes", "mailing_no"]:
             await self.mailing_confirm(update, context)
             return
+        
+        if query.data.startswith("campaign_"):
+            await self.handle_campaign_action(query)
+            return
     
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not update.message:
@@ -2418,35 +4600,9 @@ class GardenHorizonsBot:
             await update.message.reply_text("🔄 <b>Возвращаюсь в главное меню...</b>", reply_markup=reply_markup, parse_mode='HTML')
             await self.show_main_menu(update)
     
-    def fetch_api_data(self, force=False) -> Optional[Dict]:
-        try:
-            rand = random.randint(1000, 9999)
-            url = f"{API_URL}?r={rand}"
-            if force:
-                url = f"{API_URL}?t={int(datetime.now().timestamp())}&r={rand}"
-            
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-                'Accept': 'application/json',
-                'Cache-Control': 'no-cache, no-store, must-revalidate',
-                'Pragma': 'no-cache',
-                'Expires': '0'
-            }
-            
-            response = self.session.get(url, headers=headers, timeout=10)
-            
-            if response.status_code != 200:
-                return None
-            
-            data = response.json()
-            
-            if data.get("ok") and "data" in data:
-                return data["data"]
-            return None
-            
-        except Exception as e:
-            logger.error(f"❌ Ошибка API: {e}")
-            return None
+    @property
+    def last_data(self) -> Optional[Dict]:
+        return self.stock_poller.data
     
     def format_stock_message(self, data: Dict) -> Optional[str]:
         parts = []
@@ -2496,19 +4652,28 @@ class GardenHorizonsBot:
     
     async def run(self):
         logger.info("Получение данных при запуске...")
-        initial_data = self.fetch_api_data(force=True)
+        initial_data = await self.stock_poller.refresh()
+        self.stock_poller.start()
         if initial_data:
-            self.last_data = initial_data
             logger.info(f"✅ Данные загружены: {initial_data.get('lastGlobalUpdate')}")
         else:
             logger.error("❌ НЕ УДАЛОСЬ ПОЛУЧИТЬ ДАННЫЕ API!")
         
+        await channel_registry.refresh()
+        await image_registry.load()
+        self._metrics_server = await metrics.serve()
+        self._background_tasks.append(asyncio.create_task(metrics.monitor_loop()))
         await self.message_queue.start()
-        asyncio.create_task(self.discord_listener.run())
+        await self.campaigns.resume_unfinished()
+        self._background_tasks.append(asyncio.create_task(self.retention.run_forever()))
+        self._background_tasks.append(asyncio.create_task(self.discord_listener.run()))
         
         await self.application.initialize()
         await self.application.start()
         
+        # Приглашение подписаться собираем заранее, чтобы первый же отказ не ходил в API
+        await self.subscription_middleware.get_prompt()
+        
         logger.info("🤖 Бот запущен")
         logger.info(f"📡 API: {API_URL}")
         logger.info(f"📱 Основной канал: {MAIN_CHANNEL_ID}")
@@ -2519,13 +4684,45 @@ class GardenHorizonsBot:
         
         while True:
             await asyncio.sleep(10)
+    
+    async def shutdown(self):
+        """Останавливает источники сообщений, потом дописывает очередь: outbox и подтверждения не теряются"""
+        logger.info("🛑 Остановка бота...")
+        try:
+            if self.application.updater and self.application.updater.running:
+                await self.application.updater.stop()
+            if self.application.running:
+                await self.application.stop()
+        except Exception as e:
+            logger.error(f"❌ Ошибка остановки Telegram приложения: {e}")
+        
+        self.discord_listener.stop()
+        for task in self._background_tasks:
+            task.cancel()
+        await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        self._background_tasks.clear()
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+        
+        await self.campaigns.stop()
+        await self.stock_poller.stop()
+        await self.message_queue.stop()
+        
+        try:
+            await self.application.shutdown()
+        except Exception as e:
+            logger.error(f"❌ Ошибка остановки Telegram приложения: {e}")
 
 async def main():
+    bot = None
     try:
         if not BOT_TOKEN:
             logger.error("❌ Нет BOT_TOKEN")
             return
         
+        # Разовое обслуживание БД до старта: пока бот не запущен, VACUUM никого не блокирует
+        enable_incremental_vacuum()
+        
         bot = GardenHorizonsBot(BOT_TOKEN)
         await bot.run()
         
@@ -2533,6 +4730,16 @@ async def main():
         logger.error(f"❌ Критическая ошибка: {e}", exc_info=True)
         await asyncio.sleep(2)
         raise
+    finally:
+        # Сначала останавливаем рассылки, поллер и очередь (outbox и подтверждения уходят в storage),
+        # потом дописываем накопленные записи и закрываем соединения пула
+        if bot is not None:
+            try:
+                await bot.shutdown()
+            except Exception as e:
+                logger.error(f"❌ Ошибка остановки бота: {e}")
+        storage.close()
+        db_pool.close_all()
 
 if __name__ == "__main__":
     try:
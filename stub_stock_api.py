@@ -0,0 +1,120 @@
+"""Локальная заглушка API стока для проверки бота без внешнего сервиса.
+
+Отдаёт JSON в формате stock.json с ETag/Last-Modified и отвечает 304 на условные запросы.
+Сток меняется раз в --rotate секунд, чтобы было видно и новые данные, и 304.
+
+Запуск: python stub_stock_api.py [--port 8081] [--latency-ms 50] [--rotate 30]
+Затем: API_URL=http://127.0.0.1:8081/stock.json python bot.py
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SEEDS = ["Carrot", "Corn", "Onion", "Strawberry", "Mushroom", "Beetroot", "Tomato", "Apple", "Rose", "Wheat"]
+GEAR = ["Watering Can", "Basic Sprinkler", "Harvest Bell", "Turbo Sprinkler", "Favorite Tool"]
+WEATHER = ["fog", "rain", "snow", "storm", "sandstorm", "starfall"]
+
+
+class StockState:
+    def __init__(self, rotate: float):
+        self.rotate = rotate
+        self.lock = threading.Lock()
+        self.version = -1
+        self.body = b""
+        self.etag = ""
+        self.last_modified = ""
+        # Включается в тестах: сервер отвечает 503, как упавший бэкенд
+        self.fail = False
+
+    def current(self):
+        version = int(time.time() // self.rotate)
+        with self.lock:
+            if version != self.version:
+                self._generate(version)
+            return self.body, self.etag, self.last_modified
+
+    def _generate(self, version: int):
+        rnd = random.Random(version)
+        updated = int(version * self.rotate)
+        weather_type = rnd.choice(WEATHER)
+        payload = {
+            "ok": True,
+            "data": {
+                "lastGlobalUpdate": updated,
+                "seeds": [{"name": name, "quantity": rnd.randint(0, 5)} for name in SEEDS],
+                "gear": [{"name": name, "quantity": rnd.randint(0, 3)} for name in GEAR],
+                "weather": {"type": weather_type, "active": rnd.random() < 0.5, "endTimestamp": updated + 300}
+            }
+        }
+        self.version = version
+        self.body = json.dumps(payload).encode()
+        self.etag = '"' + hashlib.md5(self.body).hexdigest() + '"'
+        self.last_modified = formatdate(updated, usegmt=True)
+
+
+def make_handler(state: StockState, latency: float):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            if latency:
+                time.sleep(latency)
+            if state.fail:
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body, etag, last_modified = state.current()
+
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+        def handle(self):
+            # Клиент с дедлайном может оборвать соединение раньше ответа - это нормально
+            try:
+                super().handle()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка API стока")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--rotate", type=float, default=30)
+    args = parser.parse_args()
+
+    state = StockState(args.rotate)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(state, args.latency_ms / 1000))
+    print(f"📡 Заглушка API: http://127.0.0.1:{args.port}/stock.json (смена стока раз в {args.rotate:.0f} сек)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
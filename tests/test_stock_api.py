@@ -0,0 +1,100 @@
+"""StockApiClient и StockPoller против локальной заглушки stub_stock_api.py.
+
+Запуск: python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+TEST_DIR = tempfile.mkdtemp(prefix="test_stock_api_")
+os.environ["DB_PATH"] = os.path.join(TEST_DIR, "bot.db")
+os.environ["LOG_FILE"] = os.path.join(TEST_DIR, "bot.log")
+os.environ["METRICS_PORT"] = "0"
+os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+from stub_stock_api import StockState, make_handler  # noqa: E402
+
+
+@pytest.fixture
+def stub():
+    # Сток не меняется за время теста: второй запрос получает 304
+    state = StockState(rotate=3600)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(state, 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield state, f"http://127.0.0.1:{server.server_address[1]}/stock.json"
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_then_not_modified(stub):
+    state, url = stub
+
+    async def scenario():
+        client = bot.StockApiClient(url, timeout=5)
+        try:
+            first = await client.fetch()
+            second = await client.fetch()
+        finally:
+            await client.close()
+        return client, first, second
+
+    client, first, second = asyncio.run(scenario())
+    assert first is not None
+    assert [seed["name"] for seed in first["seeds"]] == [seed["name"] for seed in second["seeds"]]
+    assert second is first
+    assert client.requests == 2
+    assert client.not_modified == 1
+    assert client.errors == 0
+
+
+def test_poller_serves_stale_snapshot_on_server_error(stub):
+    state, url = stub
+
+    async def scenario():
+        client = bot.StockApiClient(url, timeout=5)
+        poller = bot.StockPoller(client, interval=0, max_staleness=60)
+        try:
+            initial = await poller.refresh()
+            state.fail = True
+            after_error = await poller.refresh()
+            served = await poller.get()
+            # Снимок старше max_staleness уже не отдаём
+            poller.fetched_at -= 120
+            expired = await poller.get()
+        finally:
+            await poller.stop()
+        return client, initial, after_error, served, expired
+
+    client, initial, after_error, served, expired = asyncio.run(scenario())
+    assert initial is not None
+    assert after_error is initial
+    assert served is initial
+    assert expired is None
+    assert client.errors >= 1
+    assert client.not_modified == 0
+
+
+@pytest.mark.parametrize("body", [b"[1, 2]", b"42", b'"ok"', b'{"ok": true, "data": [1]}'])
+def test_unexpected_json_shape_is_a_fetch_error(stub, body):
+    state, url = stub
+    state.current = lambda: (body, '"shape"', "")
+
+    async def scenario():
+        client = bot.StockApiClient(url, timeout=5)
+        poller = bot.StockPoller(client, interval=0, max_staleness=60)
+        try:
+            return client, await poller.refresh()
+        finally:
+            await poller.stop()
+
+    client, data = asyncio.run(scenario())
+    assert data is None
+    assert client.errors == 1